@@ -1,37 +1,79 @@
+import os
 import streamlit as st
+from requests import RequestException
 from db.db_utils import get_all_videos, get_video_by_id, get_shots_by_video, get_shot_by_id, search_shots_by_object
-from utils.search_utils import gather_all_unique_objects
-from utils.CLIP_search import load_search_components, load_clip_model, encode_query, search_clip_index
-from collections import defaultdict
+from utils.search_utils import SearchResults
+from utils.query_cache import QueryEmbeddingCache, QUERY_CACHE_PATH, ResultCache, search_key, filter_key
+from utils.thumbnails import ThumbnailCache
+from utils.startup import load_app_resources
+from search_client import SearchClient
 import dres_api
 
+# Optional search_server.py instance that does the retrieval instead of this process
+SEARCH_SERVER_URL = os.environ.get('SEARCH_SERVER_URL')
+
+# Query encoder backend, see utils/query_encoder.py
+QUERY_ENCODER = os.environ.get('QUERY_ENCODER', 'torch')
+
 st.set_page_config(page_title="Video Search Dashboard", layout="wide")
 st.title("🎬 Video Search Dashboard")
 
 # Sidebar: Video selection and search
 st.sidebar.header("Video Selection")
 
-# Load CLIP model and FAISS index once
+# Catalog, facet index, FAISS index and query encoder load on worker threads, once per process.
+# faiss, torch and transformers are only imported there, see utils/startup.py
+@st.cache_resource
+def get_app_resources():
+    # With a search server only the catalog is needed here
+    return load_app_resources(QUERY_ENCODER, search=not SEARCH_SERVER_URL, facets=not SEARCH_SERVER_URL)
+
+# Query embeddings survive reruns and restarts
 @st.cache_resource
-def get_search_components():
-    return load_search_components()
+def get_query_cache():
+    return QueryEmbeddingCache(disk_path=QUERY_CACHE_PATH)
 
+# Keyed by the catalog version, so the list is read again after a snapshot reload
 @st.cache_data
-def load_videos():
+def load_videos(catalog_version):
     return get_all_videos()
 
-@st.cache_data
-def load_objects_and_shots(videos):
-    return gather_all_unique_objects(videos, get_shots_by_video)
+# Final search and filter results of all sessions, keyed by query, filters and data version
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
 
-# Load all videos
-videos = load_videos()
+# Filter results of the search server, refreshed at the pace of its snapshot reloads
+@st.cache_data(ttl=10)
+def remote_filter(_search_client, objects, colors, brightness, videos=None):
+    if videos is None:
+        return _search_client.filter(objects, colors, brightness)
+    return _search_client.filter_shots(objects, colors, brightness, videos)
+
+@st.cache_resource
+def get_thumbnail_cache():
+    return ThumbnailCache()
+
+resources = get_app_resources()
+
+# Once everything is loaded the data comes from the current snapshot, which is swapped after an
+# ingest (utils/snapshots.py). One rerun uses one snapshot throughout.
+snapshot = resources.result('snapshots').current if resources.ready('snapshots') else None
+
+# Gather all unique detected objects, colors and brightness levels.
+# The catalog is memory-mapped from the prebuilt copy, so this wait is short
+catalog = snapshot.catalog if snapshot else resources.result('catalog')
+object_options = sorted(catalog.object_values)
+dominant_colors = catalog.color_values
+brightness_options = catalog.brightness_values
 
-# Gather all unique detected objects, colors and brightness levels
-object_options, all_shots = load_objects_and_shots(videos)
+search_client = SearchClient(SEARCH_SERVER_URL) if SEARCH_SERVER_URL else None
+facet_index = None
+if search_client is None:
+    facet_index = snapshot.facet_index if snapshot else resources.result('facets')
 
-dominant_colors = sorted({shot.get('dominant_color') for shot in all_shots if shot.get('dominant_color')})
-brightness_options = ['Dark', 'Medium', 'Light']
+# Load all videos
+videos = load_videos(catalog.version())
 
 selected_objects = st.sidebar.multiselect("Filter videos by detected object", object_options)
 selected_colors = st.sidebar.multiselect("Filter by dominant color", dominant_colors)
@@ -40,156 +82,184 @@ selected_brightness = st.sidebar.multiselect("Filter by brightness", brightness_
 # CLIP semantic search
 st.sidebar.header("Semantic Search")
 user_query = st.sidebar.text_input("Search by description (CLIP)", "")
+top_videos = st.sidebar.slider("Number of ranked videos", 10, 1000, 100, step=10)
+
+# Only one page of results is rendered at a time
+st.sidebar.header("Results")
+page_size = st.sidebar.select_slider("Videos per page", [12, 24, 48, 96], value=24)
+paging_mode = st.sidebar.radio("Show results", ["Pages", "Load more"], horizontal=True)
+
+# Semantic search is available once the index and encoder are loaded, the search server has its own
+search_engine = None
+if search_client is None:
+    if snapshot and resources.ready('encoder'):
+        search_engine = snapshot.search_engine
+        encoder = resources.result('encoder')
+    elif resources.error('snapshots') or resources.error('encoder'):
+        st.sidebar.error(f"Semantic search failed to load: {resources.error('snapshots') or resources.error('encoder')}")
+    else:
+        st.sidebar.info("Semantic search is warming up, filters and browsing already work")
+        st.sidebar.button("Check again")
+search_available = search_client is not None or search_engine is not None
+
+with st.sidebar.expander("Startup profile"):
+    st.table([{k: v if v is not None else '' for k, v in row.items()} for row in resources.report()])
+    if snapshot:
+        snapshots = resources.result('snapshots')
+        st.caption(f"Data snapshot of {len(catalog)} shots, reloaded {snapshots.reloads} times since startup")
+    result_stats = get_result_cache().stats()
+    st.caption(f"Result cache: {result_stats['entries']} entries, {result_stats['hits']} hits, "
+               f"{result_stats['misses']} misses")
+
+filters_active = bool(selected_objects or selected_colors or selected_brightness)
 
-# Load search components
-model, processor, device, faiss_index, shot_names = get_search_components()
+result_cache = get_result_cache()
 
 # Determine video ordering based on CLIP search
-if user_query and faiss_index is not None:
-    # Encode the user query
-    query_emb = encode_query(user_query, processor, model, device)
+if user_query and search_client is not None:
+    try:
+        ordered_video_ids, ordered_shots = search_client.search(user_query, top_videos, selected_objects,
+                                                                selected_colors, selected_brightness)
+    except RequestException as e:
+        # Server down, timed out or without an index: browse unranked like without semantic search
+        st.sidebar.error(f"Search server failed, showing unranked videos: {e}")
+        search_available = False
+elif user_query and search_engine is not None:
+    # Reruns from paging or opening a video hit the cache instead of encoding and searching again
+    search_result_key = search_key(user_query, top_videos, selected_objects, selected_colors,
+                                   selected_brightness, snapshot.version)
+    cached = result_cache.get(search_result_key)
+    if cached is not None:
+        ordered_video_ids, ordered_shots = cached
+    else:
+        from utils.CLIP_search import encode_query, search_clip_index
+
+        # Encode the user query
+        query_emb = encode_query(user_query, encoder, get_query_cache())
+
+        # Only shots matching the filters are ranked
+        shot_mask = None
+        if filters_active:
+            shot_mask = facet_index.shot_mask(selected_objects, selected_colors, selected_brightness)
+
+        # Search the FAISS index for the top videos only
+        ordered_video_ids, ordered_shots = search_clip_index(query_emb,
+                                        search_engine, n_videos=top_videos, shot_mask=shot_mask)
+        result_cache.put(search_result_key, (ordered_video_ids, ordered_shots), cost=len(ordered_shots) + 1)
 
-    # Search the FAISS index
-    ordered_video_ids, ordered_shots = search_clip_index(query_emb, 
-                                    faiss_index, shot_names, all_shots)
-    
-    # Create a video ordering map for display purposes
-    video_order = {vid: idx for idx, vid in enumerate(ordered_video_ids)}
+if user_query and search_available:
+    # Ranks and best shots are looked up per displayed video
+    results = SearchResults(ordered_video_ids, ordered_shots, catalog)
 
     # Reorder videos list for display
-    videos_sorted = sorted(videos, key=lambda v: video_order.get(v['video_id'], float('inf')))
+    videos_sorted = results.order_videos(videos)
 
-    st.sidebar.success(f"Found {len(ordered_video_ids)} relevant videos")
+    st.sidebar.success(f"Found {len(results)} relevant videos")
 else:
+    results = SearchResults([], [], catalog)
     videos_sorted = videos
-    ordered_video_ids = []
-    ordered_shots = []
-
-
-
-# Filter the videos based on selected filters
-if selected_objects or selected_colors or selected_brightness:
-    filtered_video_ids = set()
-
-    # Group shots by video_id for efficient lookup
-    shots_by_video = defaultdict(list)
-    for shot in all_shots:
-        shots_by_video[shot['video_id']].append(shot)
-
-    for video in videos_sorted:
-        video_id = video['video_id']
-        shots = shots_by_video.get(video_id, [])
-
-        # For each selected object, check if any shot in this video contains it
-        object_match = True
-        for obj in selected_objects:
-            found = False
-            for shot in shots:
-                shot_objs = shot.get('detected_objects', [])
-                normalized_objs = []
-                if isinstance(shot_objs, str):
-                    normalized_objs = [o.strip(" []'\"") for o in shot_objs.split(',') if o.strip(" []'\"")]
-                elif isinstance(shot_objs, list):
-                    for o in shot_objs:
-                        if isinstance(o, str):
-                            normalized_objs.extend([x.strip(" []'\"") for x in o.split(',') if x.strip(" []'\"")])
-                if obj in normalized_objs:
-                    found = True
-                    break
-            if not found:
-                object_match = False
-                break
-
-        # For color
-        color_match = (not selected_colors) or all(
-            any(shot.get('dominant_color') == color for shot in shots)
-            for color in selected_colors
-        )
-
-        # For brightness
-        brightness_match = (not selected_brightness) or all(
-            any(shot.get('brightness') == brightness for shot in shots)
-            for brightness in selected_brightness
-        )
-        
-        if object_match and color_match and brightness_match:
-            filtered_video_ids.add(video_id)
 
+
+
+# Filter the videos based on selected filters, shots are filtered unless the search server failed
+shots_filtered = filters_active
+if filters_active and search_client is not None:
+    try:
+        filtered_video_ids = remote_filter(search_client, selected_objects, selected_colors, selected_brightness)
+        videos_to_show = [v for v in videos_sorted if v['video_id'] in filtered_video_ids]
+    except RequestException as e:
+        st.sidebar.error(f"Search server failed, showing unfiltered videos: {e}")
+        shots_filtered = False
+        videos_to_show = videos_sorted
+elif filters_active:
+    filter_result_key = filter_key(selected_objects, selected_colors, selected_brightness, catalog.version())
+    cached = result_cache.get(filter_result_key)
+    if cached is None:
+        filtered_video_ids = facet_index.matching_videos(selected_objects, selected_colors, selected_brightness)
+        shot_mask = facet_index.shot_mask(selected_objects, selected_colors, selected_brightness)
+        cached = (filtered_video_ids, shot_mask)
+        # A bool per shot, about an eighth of an id
+        result_cache.put(filter_result_key, cached, cost=len(filtered_video_ids) + len(shot_mask) // 8 + 1)
+    filtered_video_ids, shot_mask = cached
     videos_to_show = [v for v in videos_sorted if v['video_id'] in filtered_video_ids]
 else:
     videos_to_show = videos_sorted
 
 
+# Start from the first page whenever the results change
+result_key = (user_query, tuple(selected_objects), tuple(selected_colors), tuple(selected_brightness),
+              top_videos, page_size)
+if st.session_state.get('result_key') != result_key:
+    st.session_state.result_key = result_key
+    st.session_state.page = 1
+    st.session_state.pages_shown = 1
+
+def load_more():
+    st.session_state.pages_shown += 1
+
+n_pages = max(1, -(-len(videos_to_show) // page_size))
+if paging_mode == "Pages":
+    page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, key='page')
+    page_start, page_end = (page - 1) * page_size, page * page_size
+else:
+    page_start, page_end = 0, st.session_state.pages_shown * page_size
+page_end = min(page_end, len(videos_to_show))
+page_videos = videos_to_show[page_start:page_end]
+
+# Matching shots are only looked up for the videos on this page
+page_video_ids = tuple(video['video_id'] for video in page_videos)
+if shots_filtered and search_client is not None:
+    try:
+        matching_shot_ids = remote_filter(search_client, selected_objects, selected_colors, selected_brightness,
+                                          page_video_ids)
+    except RequestException as e:
+        st.sidebar.error(f"Search server failed, showing all shots: {e}")
+        shots_filtered = False
+elif shots_filtered:
+    matching_shot_ids = facet_index.shot_ids_in_videos(shot_mask, page_video_ids)
+
+thumbnails = get_thumbnail_cache()
+
 # Main area: Show videos with thumbnails, play on click
-if user_query and faiss_index is not None:
+if user_query and search_available:
     st.subheader(f"Videos (ordered by similarity to: '{user_query}')")
 else:
     st.subheader("Videos")
 
-if videos_to_show:
-    cols = st.columns(min(3, len(videos_to_show)))
-    for idx, video in enumerate(videos_to_show):
+if page_videos:
+    st.caption(f"Showing {page_start + 1}-{page_end} of {len(videos_to_show)} videos")
+    cols = st.columns(min(3, len(page_videos)))
+    for idx, video in enumerate(page_videos):
         with cols[idx % len(cols)]:
             # Add similarity ranking if CLIP search was performed
-            if user_query and video['video_id'] in ordered_video_ids:
-                similarity_rank = ordered_video_ids.index(video['video_id']) + 1
-                st.markdown(f"**Video: {video['video_id']}**  #{similarity_rank}")
+            similarity_rank = results.rank.get(video['video_id'])
+            if similarity_rank:
+                score = results.score(video['video_id'])
+                score_text = f" (similarity {score:.3f})" if score is not None else ""
+                st.markdown(f"**Video: {video['video_id']}**  #{similarity_rank}{score_text}")
             else:
                 st.markdown(f"**Video: {video['video_id']}**")
             
             st.write(f"Duration: {int(video['duration'])}s")
             
-            # Get shots for this video
-            shots = [shot for shot in all_shots if shot['video_id'] == video['video_id']]
-            
-            # Order shots by CLIP relevance if search was performed, otherwise by time
-            if user_query and ordered_shots:
-                # Create a mapping of shot_name to CLIP relevance order
-                clip_shot_order = {}
-                for i, clip_shot in enumerate(ordered_shots):
-                    if clip_shot and clip_shot.get('video_id') == video['video_id']:
-                        clip_shot_order[clip_shot.get('shot_name')] = i
-                
-                # Sort shots by CLIP relevance first, then by time for shots not in CLIP results
-                shots = sorted(shots, key=lambda s: (
-                    clip_shot_order.get(s.get('shot_name'), float('inf')),  # CLIP order
-                    s.get('start_time', 0)  # Fallback to time order
-                ))
-            else:
-                # Default: order by time
-                shots = sorted(shots, key=lambda s: s.get('start_time', 0))
+            # Shots ordered by CLIP relevance if search was performed, otherwise by time
+            shots = results.shots(video['video_id'])
 
             # Filter shots by selected criteria
-            filtered_shots = []
-            for shot in shots:
-                shot_objs = shot.get('detected_objects', [])
-                normalized_objs = []
-                if isinstance(shot_objs, str):
-                    normalized_objs = [o.strip(" []'\"") for o in shot_objs.split(',') if o.strip(" []'\"")]
-                elif isinstance(shot_objs, list):
-                    for o in shot_objs:
-                        if isinstance(o, str):
-                            normalized_objs.extend([x.strip(" []'\"") for x in o.split(',') if x.strip(" []'\"")])
-                object_match = all(obj in normalized_objs for obj in selected_objects) if selected_objects else True
-
-                # Color filter
-                color_match = (not selected_colors) or (shot.get('dominant_color') in selected_colors)
-
-                # Brightness filter
-                brightness_match = (not selected_brightness) or (shot.get('brightness') in selected_brightness)
-    
-                # If all conditions match, add to filtered shots
-                if object_match and color_match and brightness_match:
-                    filtered_shots.append(shot)
+            if shots_filtered:
+                filtered_shots = [shot for shot in shots if shot['shot_id'] in matching_shot_ids]
+            else:
+                filtered_shots = shots
             
             # Show keyframe of the most relevant shot (CLIP-ordered or first shot)
             keyframe_shot = filtered_shots[0] if filtered_shots else (shots[0] if shots else None)
             
             if keyframe_shot and keyframe_shot.get('keyframe_path'):
                 caption = "Most relevant shot" if user_query else "Keyframe of first shot"
-                st.image(keyframe_shot['keyframe_path'], caption=caption, use_column_width=True)
+                st.image(thumbnails.get(keyframe_shot['keyframe_path']), caption=caption, use_column_width=True)
             
-            with st.expander("Show video and all shots"):
+            # Video and keyframes are only loaded once the user asks for them
+            if st.checkbox("Show video and all shots", key=f"show_{video['video_id']}"):
                 try:
                     st.video(video['transcoded_path'])
                 except Exception:
@@ -204,17 +274,20 @@ if videos_to_show:
                             shot_caption = f"Shot {shot.get('shot_name', '')}"
                             
                             # Add relevance indicator for CLIP search
-                            if user_query and shot.get('shot_name') in [s.get('shot_name') for s in ordered_shots if s and s.get('video_id') == video['video_id']]:
+                            if results.is_best_shot(shot):
                                 shot_caption += "Most important"
                             
                             if keyframe_time:
                                 st.markdown(f"**{shot_caption}** at {keyframe_time}s")
                             
                             st.image(
-                                shot['keyframe_path'],
+                                thumbnails.get(shot['keyframe_path']),
                                 caption=shot_caption,
                                 use_column_width=True
                             )
+
+    if paging_mode == "Load more" and page_end < len(videos_to_show):
+        st.button("Load more results", on_click=load_more)
 else:
     if user_query:
         st.info("No videos found matching your search query and selected filters.")
@@ -1,43 +1,164 @@
+import os
+import pathlib
 import sqlite3
+import threading
 from typing import List, Dict, Any, Optional
 
+import numpy as np
+
 DB_PATH = 'db/video_analysis.db'
 
+# Bytes of the DB file the read connections memory-map
+MMAP_SIZE = 1024 ** 3
+
+_local = threading.local()
+
 def get_connection(db_path: str = DB_PATH):
     """ Create and return a new database connectino """
     conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row # Get dict like rows
     return conn
 
+def get_read_connection(db_path: str = DB_PATH):
+    """ Read-only connection of the calling thread, opened once and then reused """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        conn.execute("PRAGMA cache_size = -65536") # 64 MB page cache
+        connections[db_path] = conn
+    return conn
+
 def get_all_videos() -> List[Dict[str, Any]]:
     """ Get all videos from the database """
-    with get_connection() as conn:
+    with get_read_connection() as conn:
         cur = conn.execute("SELECT * FROM videos")
         return [dict(row) for row in cur.fetchall()]
     
 def get_video_by_id(video_id: str) -> Optional[Dict[str, Any]]:
     """ Fetch a single video by its ID """
-    with get_connection() as conn:
+    with get_read_connection() as conn:
         cur = conn.execute("SELECT * FROM videos WHERE video_id = ?", (video_id,))
         return [dict(row) for row in cur.fetchall()]
     
 def get_shots_by_video(video_id: str) -> List[Dict[str, Any]]:
     """ Fetch all shots for a given video ID """
-    with get_connection() as conn:
+    with get_read_connection() as conn:
         cur = conn.execute("SELECT * FROM shots WHERE video_id = ? ORDER BY start_time", (video_id,))
         return [dict(row) for row in cur.fetchall()]
 
 def get_shot_by_id(shot_id: str) -> Optional[Dict[str, Any]]:
     """ Fetch a single shot by its ID """
-    with get_connection() as conn:
+    with get_read_connection() as conn:
         cur = conn.execute("SELECT * FROM shots WHERE id = ?", (shot_id,))
         row = cur.fetchone()
         return dict(row) if row else None
     
 def search_shots_by_object(obj: str) -> List[Dict[str, Any]]:
     """ Search for shots containing a specific object """
-    query = "SELECT * FROM shots WHERE detected_objects LIKE ?"
-    pattern = f'%"{obj}"%'
-    with get_connection() as conn:
-        cur = conn.execute(query, (pattern,))
+    query = """
+        SELECT s.* FROM objects o
+        JOIN shot_objects so ON so.object_id = o.object_id
+        JOIN shots s ON s.shot_id = so.shot_id
+        WHERE o.name = ?
+    """
+    with get_read_connection() as conn:
+        cur = conn.execute(query, (obj,))
         return [dict(row) for row in cur.fetchall()]
+
+def _encode(values: List[Any], dtype: str):
+    """ Dictionary-encode strings: (codes, sorted values), NULL becomes -1 """
+    code_of = {}
+    codes = np.array([code_of.setdefault(v, len(code_of)) for v in values], dtype='int64')
+    names = sorted(v for v in code_of if v is not None)
+
+    # Renumber so codes follow the sorted values
+    remap = np.full(len(code_of), -1, dtype=dtype)
+    for rank, name in enumerate(names):
+        remap[code_of[name]] = rank
+    return remap[codes], np.array(names, dtype=str)
+
+def pack_strings(strings: List[str]):
+    """ (utf-8 blob, offsets) of a list of strings, string i is blob[offsets[i]:offsets[i + 1]] """
+    blob = ''.join(strings).encode('utf-8')
+    offsets = np.zeros(len(strings) + 1, dtype='int64')
+    np.cumsum(np.fromiter(map(len, strings), dtype='int64', count=len(strings)), out=offsets[1:])
+    if offsets[-1] != len(blob):
+        # Non-ASCII strings are longer in bytes than in characters
+        byte_lengths = (len(s.encode('utf-8')) for s in strings)
+        np.cumsum(np.fromiter(byte_lengths, dtype='int64', count=len(strings)), out=offsets[1:])
+    return np.frombuffer(blob, dtype='uint8'), offsets
+
+def load_shot_columns(db_path: str = DB_PATH, batch_size: int = 100000) -> Dict[str, np.ndarray]:
+    """ All shots as NumPy columns, ordered by video and start time.
+
+        Numbers are arrays (NaN for missing times); video_id, brightness and
+        dominant_color are dictionary encoded as <name> codes plus
+        <name>_values; shot_name and keyframe_path are packed straight from
+        the rows into <name>_data (utf-8 blob) and <name>_offsets, without a
+        fixed-width string array in between.
+    """
+    query = """
+        SELECT shot_id, video_id, shot_name, start_time, end_time, keyframe_time,
+               keyframe_path, brightness, dominant_color
+        FROM shots
+    """
+    conn = get_read_connection(db_path)
+    cur = conn.execute(query)
+    cur.row_factory = None
+
+    # Stream the rows in batches into one list per column
+    columns = [[] for _ in range(9)]
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    shot_id, video_id, shot_name, start_time, end_time, keyframe_time, keyframe_path, brightness, color = columns
+
+    data = {
+        'shot_id': np.array(shot_id, dtype='int64'),
+        'start_time': np.array(start_time, dtype='float32'), # None becomes NaN
+        'end_time': np.array(end_time, dtype='float32'),
+        'keyframe_time': np.array(keyframe_time, dtype='float32'),
+    }
+    data['video_id'], data['video_id_values'] = _encode(video_id, 'int32')
+    data['brightness'], data['brightness_values'] = _encode(brightness, 'int16')
+    data['dominant_color'], data['dominant_color_values'] = _encode(color, 'int16')
+
+    # Sorting here is cheaper than an ORDER BY that walks the table through an index
+    order = np.lexsort((data['start_time'], data['video_id']))
+    for name, column in data.items():
+        if not name.endswith('_values'):
+            data[name] = column[order]
+
+    order = order.tolist()
+    for name, strings in (('shot_name', shot_name), ('keyframe_path', keyframe_path)):
+        data[f"{name}_data"], data[f"{name}_offsets"] = pack_strings([strings[i] or '' for i in order])
+    return data
+
+def load_shot_object_columns(db_path: str = DB_PATH) -> Dict[str, np.ndarray]:
+    """ (shot_id, object code) pairs ordered by shot_id, with object names in 'object_values' """
+    query = """
+        SELECT so.shot_id, o.name FROM shot_objects so
+        JOIN objects o ON o.object_id = so.object_id
+        ORDER BY so.shot_id
+    """
+    conn = get_read_connection(db_path)
+    cur = conn.execute(query)
+    cur.row_factory = None
+    rows = cur.fetchall()
+    objects, object_values = _encode([name for _, name in rows], 'int32')
+    return {
+        'shot_id': np.array([shot_id for shot_id, _ in rows], dtype='int64'),
+        'object': objects,
+        'object_values': object_values,
+    }
@@ -1,29 +1,441 @@
+""" Build the FAISS index over the CLIP keyframe embeddings.
+
+    Every index is wrapped in an IndexIDMap2 with stable integer shot ids,
+    and db/faiss/manifest.json records which shot has which id. This lets
+    new embeddings be appended without a rebuild and a video's vectors be
+    deleted again. Deleted videos are kept as tombstones in the manifest, so
+    neither --incremental nor a full rebuild adds their stored rows back;
+    only rows the video gets in the store after its deletion (it was
+    embedded again) are indexed.
+
+    Embeddings are read from the consolidated embedding store
+    (utils/embedding_store.py), so --incremental only reads the new rows.
+
+    Extra shot frames ("00001_shot_0_f2.jpg", see utils/keyframe_extraction.py
+    --frames-per-shot) are indexed next to the keyframes and pooled per shot at
+    query time. --frames-per-shot caps how many of them go into the index.
+
+    Usage (from the main folder):
+        python -m db.faiss_CLIP                                  # exact IndexFlatIP
+        python -m db.faiss_CLIP --incremental                    # add only new embeddings
+        python -m db.faiss_CLIP --delete-video 00001             # drop a video's vectors
+        python -m db.faiss_CLIP --index-spec "IVF4096,PQ64" --train-size 200000 \
+            --search-params nprobe=32 --benchmark
+        python -m db.faiss_CLIP --index-spec HNSW32 --search-params efSearch=128 --benchmark
+        python -m db.faiss_CLIP --index-spec SQ8
+        python -m db.faiss_CLIP --frames-per-shot 2 --pooling softmax
+"""
+import argparse
+import json
+import os
+import re
+import time
+import uuid
+
 import faiss
 import numpy as np
-import os
 
-embeddings_dir = 'data/processed/embeddings'
-embedding_files = [f for f in os.listdir(embeddings_dir) if f.endswith('npy')]
+from utils.embedding_store import EmbeddingStore, STORE_DIR
+
+INDEX_PATH = 'db/faiss/faiss_clip.index'
+SHOT_NAMES_PATH = 'db/faiss/shot_names.npy'
+INDEX_PARAMS_PATH = 'db/faiss/faiss_clip.json'
+MANIFEST_PATH = 'db/faiss/manifest.json'
+BENCHMARK_PATH = 'db/faiss/benchmark.json'
+
+
+def normalize(embeddings):
+    """ L2-normalize rows so inner product is cosine similarity """
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def video_id_from_shot_name(shot_name):
+    """ "00001_shot_0.jpg" -> "00001" """
+    return shot_name.rsplit('_shot_', 1)[0]
+
+
+_FRAME_SUFFIX = re.compile(r'_f(\d+)(?=\.jpg$)')
+
+
+def shot_key_from_frame_name(name):
+    """ "00001_shot_0_f2.jpg" -> "00001_shot_0.jpg", keyframe names are returned unchanged """
+    return _FRAME_SUFFIX.sub('', name)
+
+
+def select_vectors(names, frames_per_shot=None):
+    """ Bool mask of the store rows that go into the index.
+
+        Keyframes are always indexed. Of the extra frames of a shot at most
+        frames_per_shot, spread evenly over the shot, are; None indexes all.
+    """
+    keep = np.ones(len(names), dtype=bool)
+    if frames_per_shot is None:
+        return keep
+
+    shot_frames = {}
+    for row, name in enumerate(names):
+        match = _FRAME_SUFFIX.search(name)
+        if match:
+            keep[row] = False
+            shot_frames.setdefault(shot_key_from_frame_name(name), []).append((int(match.group(1)), row))
+
+    for frames in shot_frames.values():
+        if frames_per_shot <= 0:
+            continue
+        frames.sort()
+        picked = np.unique(np.linspace(0, len(frames) - 1, min(frames_per_shot, len(frames))).round().astype(int))
+        keep[[frames[i][1] for i in picked]] = True
+    return keep
+
+
+def drop_deleted(names, keep, deleted):
+    """ Clear keep for the store rows of deleted videos.
+
+        deleted maps a video id to the store size when it was last deleted.
+        Rows appended after that (the video was embedded again) are kept, so
+        the tombstone only ever hides the rows that were deleted.
+    """
+    if not deleted:
+        return keep
+    keep = keep.copy()
+    for row, name in enumerate(names):
+        first_new_row = deleted.get(video_id_from_shot_name(name))
+        if first_new_row is not None and row < first_new_row:
+            keep[row] = False
+    return keep
+
+
+def _indexed_chunks(store, keep=None):
+    """ (embeddings, ids) chunks of the store rows selected by keep, store row i has id i """
+    for first_row, _, chunk in store.iter_chunks():
+        ids = np.arange(first_row, first_row + len(chunk), dtype='int64')
+        if keep is not None:
+            chunk_keep = keep[first_row:first_row + len(chunk)]
+            chunk, ids = chunk[chunk_keep], ids[chunk_keep]
+        if store.dtype != np.float32:
+            chunk = normalize(chunk)
+        yield chunk, ids
+
+
+def build_index(store, index_spec='Flat', train_size=100000, seed=42, keep=None):
+    """ Build an ID-mapped FAISS index from an index_factory spec string.
+
+        Examples: "Flat", "IVF4096,PQ64", "IVF1024,Flat", "HNSW32", "SQ8".
+        Indexes that need training are trained on a random sample of
+        train_size embeddings. Store row i gets the shot id i; keep is an
+        optional row mask from select_vectors.
+    """
+    base_index = faiss.index_factory(store.dim, index_spec, faiss.METRIC_INNER_PRODUCT)
+    index = faiss.IndexIDMap2(base_index)
+
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        rows = np.arange(len(store)) if keep is None else np.flatnonzero(keep)
+        n_train = min(train_size, len(rows))
+        sample_rows = np.sort(rng.choice(rows, n_train, replace=False))
+        print(f"Training {index_spec} on {n_train} embeddings...")
+        index.train(normalize(store.get_rows(sample_rows)))
+
+    # Embeddings are stored normalized, float32 chunks are added straight from the memmap
+    for chunk, ids in _indexed_chunks(store, keep):
+        index.add_with_ids(chunk, ids)
+    return index
+
+
+def new_manifest(shot_names, index_spec, search_params, keep=None, frames_per_shot=None, pooling='max',
+                 deleted=None):
+    """ Manifest for a freshly built index where shot i has id i """
+    videos = {}
+    shots = {}
+    for shot_id, shot_name in enumerate(shot_names):
+        if keep is None or keep[shot_id]:
+            videos.setdefault(video_id_from_shot_name(shot_name), []).append(shot_id)
+            shots[shot_name] = shot_id
+    return {
+        "index_spec": index_spec,
+        "search_params": search_params,
+        "frames_per_shot": frames_per_shot,
+        "pooling": pooling,
+        "next_id": len(shot_names),
+        "shots": shots,
+        "videos": videos,
+        "deleted": dict(deleted or {}),
+    }
+
+
+def frames_per_shot_stats(manifest):
+    """ (mean, max) number of indexed vectors per shot, what the search sizes k and pooling by """
+    counts = {}
+    for shot_name in manifest['shots']:
+        shot_key = shot_key_from_frame_name(shot_name)
+        counts[shot_key] = counts.get(shot_key, 0) + 1
+    if not counts:
+        return 1.0, 1
+    return len(manifest['shots']) / len(counts), max(counts.values())
+
+
+def load_manifest():
+    with open(MANIFEST_PATH, 'r') as f:
+        return json.load(f)
+
+
+def saved_tombstones():
+    """ Deleted videos of the saved manifest, carried over by a full rebuild """
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    return load_manifest().get('deleted', {})
+
+
+def build_full(store, index_spec='Flat', train_size=100000, search_params='', frames_per_shot=None,
+               pooling='max', deleted=None):
+    """ Build a new index over the whole store, returns (index, manifest, keep) """
+    keep = drop_deleted(store.names(), select_vectors(store.names(), frames_per_shot), deleted)
+    print(f"Building index over {int(keep.sum())} of {len(store)} embeddings")
+
+    start = time.perf_counter()
+    index = build_index(store, index_spec, train_size, keep=keep)
+    print(f"Built {index_spec} index in {time.perf_counter() - start:.1f}s")
+
+    apply_search_params(index, search_params)
+    manifest = new_manifest(store.names(), index_spec, search_params, keep, frames_per_shot, pooling, deleted)
+    return index, manifest, keep
+
+
+def add_new_embeddings(index, manifest, store):
+    """ Append only the embeddings that are not in the manifest yet.
+
+        New shots get fresh ids from manifest["next_id"]; ids are never reused.
+        The manifest's frames_per_shot budget applies to new frames as well.
+        Rows of deleted videos are skipped unless they were embedded after
+        the deletion. Returns the number of added vectors.
+    """
+    indexed = manifest['shots']
+    names = store.names()
+    keep = drop_deleted(names, select_vectors(names, manifest.get('frames_per_shot')), manifest.get('deleted'))
+    new_rows = [row for row, name in enumerate(names) if keep[row] and name not in indexed]
+    if not new_rows:
+        return 0
+
+    new_shot_names = [names[row] for row in new_rows]
+    embeddings = normalize(store.get_rows(new_rows))
+    first_id = manifest['next_id']
+    new_ids = np.arange(first_id, first_id + len(new_rows), dtype='int64')
+    index.add_with_ids(embeddings, new_ids)
+
+    for shot_id, shot_name in zip(new_ids.tolist(), new_shot_names):
+        indexed[shot_name] = shot_id
+        manifest['videos'].setdefault(video_id_from_shot_name(shot_name), []).append(shot_id)
+    manifest['next_id'] = first_id + len(new_rows)
+    return len(new_rows)
+
+
+def delete_video(index, manifest, video_id, store_rows):
+    """ Remove all vectors of a video from the index and the manifest.
+
+        The video's rows stay in the append-only embedding store, so it is
+        recorded as deleted with the current store size store_rows: only rows
+        appended after that are indexed for it again.
+    """
+    manifest.setdefault('deleted', {})[video_id] = store_rows
+    shot_ids = manifest['videos'].pop(video_id, [])
+    if not shot_ids:
+        return 0
+
+    try:
+        removed = index.remove_ids(faiss.IDSelectorBatch(np.array(shot_ids, dtype='int64')))
+    except RuntimeError as e:
+        raise RuntimeError(f"{manifest['index_spec']} index does not support deleting vectors "
+                           f"(e.g. HNSW), rebuild the index instead") from e
+
+    deleted = set(shot_ids)
+    manifest['shots'] = {name: i for name, i in manifest['shots'].items() if i not in deleted}
+    return removed
+
+
+def apply_search_params(index, search_params):
+    """ Set search-time parameters like "nprobe=32" or "efSearch=128" """
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params)
+
+
+def default_param_sweep(index_spec):
+    """ Search parameter values worth benchmarking for an index type """
+    if 'IVF' in index_spec:
+        return [f"nprobe={n}" for n in (1, 4, 16, 64, 256)]
+    if 'HNSW' in index_spec:
+        return [f"efSearch={n}" for n in (16, 32, 64, 128, 256)]
+    return ['']
+
+
+def benchmark_index(index, store, param_sweep, k=10, n_queries=1000, seed=42, keep=None):
+    """ Measure recall@k and latency of index against an exact flat index.
+
+        Queries are sampled stored embeddings with a little noise, so the
+        query is not trivially its own nearest neighbour.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.arange(len(store)) if keep is None else np.flatnonzero(keep)
+    n_queries = min(n_queries, len(rows))
+    queries = store.get_rows(np.sort(rng.choice(rows, n_queries, replace=False)))
+    queries = normalize(queries + rng.normal(0, 0.02, queries.shape).astype('float32'))
+
+    # Ground truth from brute-force inner product, ids match build_index
+    flat = faiss.IndexIDMap(faiss.IndexFlatIP(store.dim))
+    for chunk, ids in _indexed_chunks(store, keep):
+        flat.add_with_ids(chunk, ids)
+    start = time.perf_counter()
+    _, ground_truth = flat.search(queries, k)
+    flat_ms = (time.perf_counter() - start) * 1000 / n_queries
+
+    report = [{"search_params": "exact (Flat)", "recall": 1.0, "ms_per_query": flat_ms}]
+    for params in param_sweep:
+        apply_search_params(index, params)
+        start = time.perf_counter()
+        _, I = index.search(queries, k)
+        ms_per_query = (time.perf_counter() - start) * 1000 / n_queries
+
+        hits = sum(len(np.intersect1d(I[q], ground_truth[q])) for q in range(n_queries))
+        report.append({
+            "search_params": params or "default",
+            "recall": hits / (n_queries * k),
+            "ms_per_query": ms_per_query,
+        })
+    return report
+
+
+def print_benchmark(report, k):
+    print(f"{'search params':<20} {f'recall@{k}':>10} {'ms/query':>10}")
+    for row in report:
+        print(f"{row['search_params']:<20} {row['recall']:>10.4f} {row['ms_per_query']:>10.3f}")
+
+
+def _write_npy(array, path):
+    with open(path, 'wb') as f:
+        np.save(f, array)
+
+
+def _write_json(data, path, indent=None):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=indent)
+
+
+def _write_params(data, path):
+    _write_json(data, path, indent=4)
+
+
+def _replace_file(path, write, data):
+    """ Write to a temporary file first so readers never see a half-written file """
+    tmp_path = path + '.tmp'
+    write(data, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_index(index, manifest):
+    """ Save index, manifest, id-ordered shot names and the parameters needed to load it.
+
+        The parameters are written last and carry a new version id, so the
+        app's snapshot watcher only reloads once all files are in place.
+    """
+    # shot_names[id] is the shot name of FAISS id, '' for deleted ids
+    shot_names = [''] * manifest['next_id']
+    for shot_name, shot_id in manifest['shots'].items():
+        shot_names[shot_id] = shot_name
+
+    _replace_file(INDEX_PATH, faiss.write_index, index)
+    _replace_file(SHOT_NAMES_PATH, _write_npy, np.array(shot_names))
+    _replace_file(MANIFEST_PATH, _write_json, manifest)
+    mean_vectors, max_vectors = frames_per_shot_stats(manifest)
+    _replace_file(INDEX_PARAMS_PATH, _write_params, {
+        "index_spec": manifest['index_spec'],
+        "search_params": manifest['search_params'],
+        "frames_per_shot": manifest.get('frames_per_shot'),
+        "pooling": manifest.get('pooling', 'max'),
+        "mean_vectors_per_shot": mean_vectors,
+        "max_vectors_per_shot": max_vectors,
+        "ntotal": index.ntotal,
+        "dim": index.d,
+        "version": uuid.uuid4().hex,
+    })
+
+
+def update_index(store=None, incremental=True, delete_videos=(), search_params='', pooling=''):
+    """ Update the saved index in place: delete videos, then append new embeddings.
+
+        Without a saved index (e.g. the first ingest of a collection) an
+        exact index over the whole store is built instead.
+    """
+    store = store or EmbeddingStore()
+    if os.path.exists(INDEX_PATH) and os.path.exists(MANIFEST_PATH):
+        index = faiss.read_index(INDEX_PATH)
+        manifest = load_manifest()
+    else:
+        print("No saved index yet, building one over the whole store")
+        index, manifest, _ = build_full(store, search_params=search_params, pooling=pooling or 'max')
+
+    for video_id in delete_videos:
+        removed = delete_video(index, manifest, video_id, len(store))
+        print(f"Removed {removed} vectors of video {video_id}")
+
+    if incremental:
+        start = time.perf_counter()
+        added = add_new_embeddings(index, manifest, store)
+        print(f"Added {added} new embeddings in {time.perf_counter() - start:.1f}s")
+
+    if search_params:
+        manifest['search_params'] = search_params
+    if pooling:
+        manifest['pooling'] = pooling
+    apply_search_params(index, manifest['search_params'])
+    save_index(index, manifest)
+    print(f"Index now holds {index.ntotal} vectors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the FAISS index for CLIP embeddings")
+    parser.add_argument('--store', default=STORE_DIR, help='embedding store directory')
+    parser.add_argument('--index-spec', default='Flat',
+                        help='faiss index_factory string, e.g. Flat, "IVF4096,PQ64", HNSW32, SQ8')
+    parser.add_argument('--train-size', type=int, default=100000,
+                        help='number of embeddings used to train IVF/PQ/SQ indexes')
+    parser.add_argument('--search-params', default='',
+                        help='search-time parameters saved with the index, e.g. nprobe=32 or efSearch=128')
+    parser.add_argument('--frames-per-shot', type=int, default=None,
+                        help='extra frames indexed per shot besides its keyframe (default: all in the store)')
+    parser.add_argument('--pooling', choices=['max', 'mean', 'softmax'], default=None,
+                        help='how the scores of a shot\'s frames are combined at query time (default: max)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='append only embeddings missing from the manifest to the existing index')
+    parser.add_argument('--delete-video', nargs='*', default=[],
+                        help='video ids whose vectors are removed from the existing index')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='report recall@k vs latency against the exact flat index')
+    parser.add_argument('--benchmark-params', nargs='*',
+                        help='search parameter values to benchmark (default: a sweep for the index type)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--n-queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store)
 
+    if args.incremental or args.delete_video:
+        update_index(store, args.incremental, args.delete_video, args.search_params, args.pooling)
+        return
 
-all_embeddings = []
-shot_names = []
+    index, manifest, keep = build_full(store, args.index_spec, args.train_size, args.search_params,
+                                       args.frames_per_shot, args.pooling or 'max', saved_tombstones())
 
-for fname in embedding_files:
-    emb = np.load(os.path.join(embeddings_dir, fname))
-    # emb shape: (1, 512) or (512,)
-    emb = emb.squeeze() # Ensure it's 1D
-    all_embeddings.append(emb)
-    shot_names.append(fname.replace('_embeddings.npy', ''))
+    if args.benchmark:
+        param_sweep = args.benchmark_params or default_param_sweep(args.index_spec)
+        report = benchmark_index(index, store, param_sweep, args.k, args.n_queries, keep=keep)
+        print_benchmark(report, args.k)
+        with open(BENCHMARK_PATH, 'w') as f:
+            json.dump({"index_spec": args.index_spec, "k": args.k, "results": report}, f, indent=4)
+        # The sweep leaves the last benchmarked parameters set
+        apply_search_params(index, args.search_params)
 
-all_embeddings = np.stack(all_embeddings).astype('float32')
-# Normalize the embeddings
-all_embeddings = all_embeddings / np.linalg.norm(all_embeddings, axis=1, keepdims=True)
+    save_index(index, manifest)
+    print(f"Saved index to {INDEX_PATH}")
 
-# Build FAISS index
-index = faiss.IndexFlatIP(512) # Using Inner Product for similarity
-index.add(all_embeddings)
 
-# Save index and shot names
-faiss.write_index(index, 'db/faiss/faiss_clip.index')
-np.save('db/faiss/shot_names.npy', np.array(shot_names))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
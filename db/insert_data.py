@@ -1,6 +1,100 @@
+""" Insert videos and shots into the SQLite database.
+
+    Usage (from the main folder):
+        python -m db.insert_data                                 # all videos
+        python -m db.insert_data --videos 00001 00002
+        python -m db.insert_data --migrate                       # add shot_objects to an older DB
+        python -m db.insert_data --bulk                          # fast load of the whole collection
+"""
+import argparse
 import sqlite3
 import json
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+DB_PATH = 'db/video_analysis.db'
+SCHEMA_PATH = 'db/schema.sql'
+SHOT_INFO_DIR = 'data/processed/video_shot_info'
+METADATA_DIR = 'data/processed/metadata'
+
+# Secondary indexes dropped during a bulk load and rebuilt from schema.sql afterwards
+BULK_DROP_INDEXES = ('idx_shot_objects_shot', 'idx_shots_video_start', 'idx_shots_color', 'idx_shots_brightness')
+
+
+def connect(db_path=DB_PATH):
+    """ Writer connection; WAL lets the app keep reading while videos are inserted """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+def parse_detected_objects(detected_objects):
+    """ Object names from the detected_objects column (JSON array or legacy comma list) """
+    if not detected_objects:
+        return []
+    try:
+        objects = json.loads(detected_objects)
+    except ValueError:
+        objects = [detected_objects]
+    if isinstance(objects, str):
+        objects = [objects]
+
+    names = []
+    for o in objects:
+        names.extend(x.strip(" []'\"") for x in str(o).split(','))
+    return [name for name in names if name]
+
+
+def bump_version(cur):
+    """ Give the shot data a new version, call before committing any change to shots or shot_objects.
+
+        Counts of rows can stay the same when contents change (e.g. a reload
+        with new colors), the shot catalog and the app's snapshot watcher
+        compare this version instead.
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (uuid.uuid4().hex,))
+
+
+def insert_shot_objects(cur, shot_id, object_confidences):
+    """ Insert {object name: confidence} of one shot into objects and shot_objects """
+    for name, confidence in object_confidences.items():
+        cur.execute("INSERT OR IGNORE INTO objects (name) VALUES (?)", (name,))
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO shot_objects (object_id, shot_id, confidence)
+            VALUES ((SELECT object_id FROM objects WHERE name = ?), ?, ?)
+            """,
+            (name, shot_id, confidence)
+        )
+
+
+def migrate_database(db_path=DB_PATH, schema_path=SCHEMA_PATH):
+    """ Create the objects/shot_objects tables and indexes and fill them from detected_objects """
+    conn = connect(db_path)
+    cur = conn.cursor()
+
+    # Every statement in the schema is CREATE ... IF NOT EXISTS
+    with open(schema_path, 'r') as f:
+        cur.executescript(f.read())
+
+    rows = cur.execute(
+        """
+        SELECT shot_id, detected_objects FROM shots
+        WHERE shot_id NOT IN (SELECT shot_id FROM shot_objects)
+        """
+    ).fetchall()
+    for shot_id, detected_objects in rows:
+        # Confidences are unknown for shots inserted before the migration
+        insert_shot_objects(cur, shot_id, {name: None for name in parse_detected_objects(detected_objects)})
+
+    bump_version(cur)
+    conn.commit()
+    conn.close()
+    print(f"Migrated objects of {len(rows)} shots")
+
 
 def add_video_from_json(
         db_path,
@@ -17,7 +111,7 @@ def add_video_from_json(
     duration = info['duration']
 
     # Connect to DB
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cur = conn.cursor()
 
     # Insert into videos table
@@ -48,9 +142,16 @@ def add_shots_from_json(
     shots = info['shots']
 
     # Connect to DB
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cur = conn.cursor()
 
+    # Replace the video's shots so reinserting a video does not duplicate them
+    cur.execute(
+        "DELETE FROM shot_objects WHERE shot_id IN (SELECT shot_id FROM shots WHERE video_id = ?)",
+        (video_id,)
+    )
+    cur.execute("DELETE FROM shots WHERE video_id = ?", (video_id,))
+
     # Insert shots from metadata JSON files
     for shot in shots:
         shot_name = shot['shot_name']
@@ -74,27 +175,212 @@ def add_shots_from_json(
             )
         )
 
+        # Older metadata files have no confidences
+        object_confidences = metadata.get('object_confidences') or \
+            {name: None for name in metadata.get('detected_objects', [])}
+        insert_shot_objects(cur, cur.lastrowid, object_confidences)
+
+    bump_version(cur)
     conn.commit()
     conn.close()
     
 
 
 
-videos_list = sorted([f for f in os.listdir('data/videos') if f.endswith('.mp4')])
-
-# USE ONLY THE FIRST 5 VIDEOS FOR NOW
-for video_file in videos_list[15:]:
-    video_name = video_file.split('.')[0]
-
+def insert_video(video_name, db_path=DB_PATH):
+    """ Insert one video and all its shots """
     add_video_from_json(
-    db_path='db/video_analysis.db',
-    video_shot_info_path=f'data/processed/video_shot_info/{video_name}_shots.json',
-    video_path=f'data/videos/{video_name}.mp4',
-    transcoded_path=f'data/transcoded/{video_name}.mp4'
+        db_path=db_path,
+        video_shot_info_path=f'data/processed/video_shot_info/{video_name}_shots.json',
+        video_path=f'data/videos/{video_name}.mp4',
+        transcoded_path=f'data/transcoded/{video_name}.mp4'
     )
 
     add_shots_from_json(
-    db_path='db/video_analysis.db',
-    video_shot_info_path=f'data/processed/video_shot_info/{video_name}_shots.json',
-    metadata_dir='data/processed/metadata'
+        db_path=db_path,
+        video_shot_info_path=f'data/processed/video_shot_info/{video_name}_shots.json',
+        metadata_dir='data/processed/metadata'
     )
+
+
+def read_video_rows(video_name, shot_info_dir=SHOT_INFO_DIR, metadata_dir=METADATA_DIR):
+    """ Video row and (shot row, object confidences) of all its shots, read from the JSON files """
+    with open(os.path.join(shot_info_dir, f"{video_name}_shots.json"), 'r') as f:
+        info = json.load(f)
+    video_id = info['video_name']
+    video_row = (video_id, f'data/videos/{video_name}.mp4', f'data/transcoded/{video_name}.mp4',
+                 info['duration'], info['fps'])
+
+    shots = []
+    for shot in info['shots']:
+        with open(os.path.join(metadata_dir, f"{shot['shot_name']}_{video_id}_metadata.json"), 'r') as f:
+            metadata = json.load(f)
+        detected_objects = metadata.get('detected_objects', [])
+        shot_row = (shot['shot_name'], video_id, shot['start_time'], shot['end_time'], shot['keyframe_time'],
+                    metadata['keyframe_path'], metadata['brightness'], metadata['dominant_color'],
+                    json.dumps(detected_objects))
+        shots.append((shot_row, metadata.get('object_confidences') or {name: None for name in detected_objects}))
+    return video_row, shots
+
+
+def _read_or_skip(video_name, shot_info_dir, metadata_dir):
+    """ (video name, rows or None, error) so one unreadable video does not stop a bulk load """
+    try:
+        video_row, shots = read_video_rows(video_name, shot_info_dir, metadata_dir)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return video_name, None, e
+    return video_name, (video_row, shots), None
+
+
+def next_shot_id(cur):
+    """ The id AUTOINCREMENT would assign next, never one freed by a delete """
+    seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'shots'").fetchone()
+    max_id = cur.execute("SELECT MAX(shot_id) FROM shots").fetchone()[0]
+    return max(seq[0] if seq else 0, max_id or 0) + 1
+
+
+def bulk_load(videos, db_path=DB_PATH, batch_rows=50000, workers=8,
+              shot_info_dir=SHOT_INFO_DIR, metadata_dir=METADATA_DIR):
+    """ Load many videos with executemany in large transactions.
+
+        All JSON files of a video are read and validated before it is
+        written; videos with missing or broken files are skipped, keep their
+        current rows and are returned. A video's old rows are deleted in the
+        same transaction that inserts its new ones. Durability is relaxed
+        (synchronous=OFF) for the load and the secondary indexes are rebuilt
+        once at the end, also when the load fails.
+    """
+    conn = connect(db_path)
+    cur = conn.cursor()
+    with open(SCHEMA_PATH, 'r') as f:
+        schema = f.read()
+    cur.executescript(schema)
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.execute("PRAGMA cache_size = -262144") # 256 MB
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_videos (video_id TEXT PRIMARY KEY)")
+
+    # Looked up while the video index still exists, only these need their old rows deleted
+    loaded_videos = {row[0] for row in cur.execute("SELECT DISTINCT video_id FROM shots")}
+
+    # Shot ids are assigned here so shot_objects rows can be batched too. Inserting them explicitly
+    # moves sqlite_sequence past them, like the AUTOINCREMENT path of add_shots_from_json
+    shot_id = next_shot_id(cur)
+    object_ids = dict(cur.execute("SELECT name, object_id FROM objects").fetchall())
+
+    video_rows, shot_rows, object_rows = [], [], []
+    failed = []
+    n_videos = n_shots = 0
+    start_time = time.perf_counter()
+
+    def flush():
+        # Deleting and inserting in one transaction, a failed batch leaves the old rows in place
+        replaced = [(row[0],) for row in video_rows if row[0] in loaded_videos]
+        if replaced:
+            cur.execute("DELETE FROM bulk_videos")
+            cur.executemany("INSERT INTO bulk_videos (video_id) VALUES (?)", replaced)
+            cur.execute("""
+                DELETE FROM shot_objects WHERE shot_id IN
+                    (SELECT shot_id FROM shots WHERE video_id IN (SELECT video_id FROM bulk_videos))
+                """)
+            cur.execute("DELETE FROM shots WHERE video_id IN (SELECT video_id FROM bulk_videos)")
+        cur.executemany(
+            "INSERT OR REPLACE INTO videos (video_id, video_path, transcoded_path, duration, fps) VALUES (?, ?, ?, ?, ?)",
+            video_rows)
+        cur.executemany(
+            """
+            INSERT INTO shots (
+                shot_id, shot_name, video_id, start_time, end_time, keyframe_time,
+                keyframe_path, brightness, dominant_color, detected_objects
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            shot_rows)
+        cur.executemany("INSERT OR REPLACE INTO shot_objects (object_id, shot_id, confidence) VALUES (?, ?, ?)",
+                        object_rows)
+        bump_version(cur)
+        conn.commit()
+        del video_rows[:], shot_rows[:], object_rows[:]
+
+    try:
+        for index in BULK_DROP_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {index}")
+
+        # JSON files are read by a thread pool, a chunk of videos ahead of the writer
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for chunk_start in range(0, len(videos), workers * 8):
+                chunk = videos[chunk_start:chunk_start + workers * 8]
+                for video_name, rows, error in pool.map(
+                        lambda v: _read_or_skip(v, shot_info_dir, metadata_dir), chunk):
+                    if rows is None:
+                        failed.append(video_name)
+                        print(f"Skipped {video_name}: {error}")
+                        continue
+
+                    video_row, shots = rows
+                    video_rows.append(video_row)
+                    n_videos += 1
+                    for shot_row, object_confidences in shots:
+                        shot_rows.append((shot_id,) + shot_row)
+                        for name, confidence in object_confidences.items():
+                            if name not in object_ids:
+                                cur.execute("INSERT INTO objects (name) VALUES (?)", (name,))
+                                object_ids[name] = cur.lastrowid
+                            object_rows.append((object_ids[name], shot_id, confidence))
+                        shot_id += 1
+
+                    if len(shot_rows) >= batch_rows:
+                        n_shots += len(shot_rows)
+                        flush()
+                        elapsed = time.perf_counter() - start_time
+                        print(f"Loaded {n_shots} shots ({n_shots / elapsed:.0f} rows/s)")
+
+        n_shots += len(shot_rows)
+        flush()
+    finally:
+        load_seconds = time.perf_counter() - start_time
+        conn.rollback()
+
+        # Rebuild the secondary indexes in one pass each and refresh the planner statistics
+        index_start = time.perf_counter()
+        cur.executescript(schema)
+        cur.execute("ANALYZE")
+        conn.commit()
+        conn.close()
+
+    print(f"Loaded {n_videos} videos and {n_shots} shots in {load_seconds:.1f}s "
+          f"({n_shots / max(load_seconds, 1e-9):.0f} rows/s), indexes built in {time.perf_counter() - index_start:.1f}s")
+    if failed:
+        print(f"Skipped {len(failed)} videos with missing or invalid files: {' '.join(failed[:20])}"
+              f"{' ...' if len(failed) > 20 else ''}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Insert videos and shots into the database")
+    parser.add_argument('--videos', nargs='*', help='video ids to insert (default: all)')
+    parser.add_argument('--db-path', default=DB_PATH)
+    parser.add_argument('--migrate', action='store_true',
+                        help='create shot_objects and indexes in an existing DB and backfill them')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load all videos in large transactions and build the indexes afterwards')
+    parser.add_argument('--batch-rows', type=int, default=50000, help='shots per bulk transaction')
+    parser.add_argument('--workers', type=int, default=8, help='threads reading the JSON files')
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_database(args.db_path)
+        return
+
+    videos_list = args.videos or sorted(f.split('.')[0] for f in os.listdir('data/videos') if f.endswith('.mp4'))
+
+    if args.bulk:
+        bulk_load(videos_list, args.db_path, args.batch_rows, args.workers)
+        return
+
+    for video_name in videos_list:
+        insert_video(video_name, args.db_path)
+        print(f"Inserted {video_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ CREATE TABLE IF NOT EXISTS videos (
 -- shots table
 CREATE TABLE IF NOT EXISTS shots (
     shot_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    shot_name = TEXT,
+    shot_name TEXT,
     video_id TEXT NOT NULL,
     start_time REAL, -- when the shot starts in seconds
     end_time REAL, -- when the shot ends in seconds
@@ -18,9 +18,37 @@ CREATE TABLE IF NOT EXISTS shots (
     keyframe_path TEXT,
     brightness TEXT, -- 'dark', 'medium', 'bright'
     dominant_color TEXT,
-    detected_objects TEXT, -- JSON array like ["person", "car"]
+    detected_objects TEXT, -- JSON array like ["person", "car"], kept for compatibility
     FOREIGN KEY(video_id) REFERENCES videos(video_id)
 );
 
+-- dictionary of detected object classes
+CREATE TABLE IF NOT EXISTS objects (
+    object_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+-- objects detected in every shot, the primary key covers object -> shots lookups
+CREATE TABLE IF NOT EXISTS shot_objects (
+    object_id INTEGER NOT NULL,
+    shot_id INTEGER NOT NULL,
+    confidence REAL, -- highest YOLO confidence of the class in the keyframe
+    PRIMARY KEY (object_id, shot_id),
+    FOREIGN KEY(object_id) REFERENCES objects(object_id),
+    FOREIGN KEY(shot_id) REFERENCES shots(shot_id)
+) WITHOUT ROWID;
+
+-- version of the shot data, replaced by every writer in db/insert_data.py on commit
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- indexes for shot -> objects and for the video/color/brightness filters
+CREATE INDEX IF NOT EXISTS idx_shot_objects_shot ON shot_objects(shot_id, object_id, confidence);
+CREATE INDEX IF NOT EXISTS idx_shots_video_start ON shots(video_id, start_time);
+CREATE INDEX IF NOT EXISTS idx_shots_color ON shots(dominant_color, video_id);
+CREATE INDEX IF NOT EXISTS idx_shots_brightness ON shots(brightness, video_id);
+
 -- CLIP embeddings
 -- CLIP embeddings are stored in FAISS
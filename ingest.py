@@ -0,0 +1,288 @@
+""" Ingest videos end to end as a DAG of stages:
+
+        keyframes (shots + keyframes) -> embeddings
+                                      -> metadata -> database
+
+    Every stage runs on its own process pool and only takes new work while
+    the queues of the stages after it are below --queue-size, so a slow stage
+    applies backpressure instead of letting work pile up. Finished stages are
+    recorded per video in data/processed/ingest_state.json: reruns skip them,
+    and a failed video is logged and does not stop the others.
+
+    Usage (from the main folder):
+        python ingest.py
+        python ingest.py --keyframe-workers 2 --embedding-workers 1 --metadata-workers 4
+        python ingest.py --videos 00001 00002 --retry-failed --update-index
+        python ingest.py --frames-per-shot 4 --frame-sampling change
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+VIDEOS_DIR = 'data/videos'
+SHOT_INFO_DIR = 'data/processed/video_shot_info'
+FRAMES_DIR = 'data/processed/shot_frames'
+STATE_PATH = 'data/processed/ingest_state.json'
+
+# Stage -> stages that must be finished first, in topological order
+STAGES = {
+    'keyframes': [],
+    'embeddings': ['keyframes'],
+    'metadata': ['keyframes'],
+    'database': ['metadata'],
+}
+
+
+def _video_shots(video_name):
+    with open(os.path.join(SHOT_INFO_DIR, f"{video_name}_shots.json"), 'r') as f:
+        return json.load(f)['shots']
+
+
+def _keyframe_names(video_name):
+    return [os.path.basename(shot['keyframe_path']) for shot in _video_shots(video_name)]
+
+
+def _frame_names(video_name):
+    """ Extra shot frames saved with --frames-per-shot """
+    return [os.path.basename(frame['path']) for shot in _video_shots(video_name) for frame in shot.get('frames', [])]
+
+
+# Stage functions run inside the pool processes, heavy imports happen there
+
+# Thumbnail cache of this worker process, scanning the thumbnail folder once instead of per video
+_thumbnail_cache = None
+
+
+def _worker_thumbnail_cache():
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        from utils.thumbnails import ThumbnailCache
+        _thumbnail_cache = ThumbnailCache()
+    return _thumbnail_cache
+
+
+def run_keyframes(video_name, frames_per_shot=0, frame_sampling='uniform'):
+    from utils.keyframe_extraction import extract_shots_and_keyframes
+    video_info = extract_shots_and_keyframes(os.path.join(VIDEOS_DIR, f"{video_name}.mp4"),
+                                             video_name, verbose=False, frames_per_shot=frames_per_shot,
+                                             frame_sampling=frame_sampling)
+    # Small thumbnails for the result grid, so the app never has to read full keyframes
+    from utils.thumbnails import make_thumbnails
+    make_thumbnails([shot['keyframe_path'] for shot in video_info['shots']], _worker_thumbnail_cache())
+    return len(video_info['shots'])
+
+
+def run_embeddings(video_name, skip=()):
+    import numpy as np
+    from utils.CLIP_embeddings import embed_keyframes
+    shot_names, embeddings = embed_keyframes([name for name in _keyframe_names(video_name) if name not in skip])
+    frame_names = [name for name in _frame_names(video_name) if name not in skip]
+    if frame_names:
+        frame_names, frame_embeddings = embed_keyframes(frame_names, keyframes_dir=FRAMES_DIR)
+        shot_names, embeddings = shot_names + frame_names, np.concatenate([embeddings, frame_embeddings])
+    return shot_names, embeddings
+
+
+def run_metadata(video_name, color_method='kmeans'):
+    from utils.metadata_creation import create_video_metadata
+    return create_video_metadata(video_name, color_method=color_method)
+
+
+def run_database(video_name):
+    from db.insert_data import insert_video
+    insert_video(video_name)
+
+
+STAGE_FUNCS = {
+    'keyframes': run_keyframes,
+    'embeddings': run_embeddings,
+    'metadata': run_metadata,
+    'database': run_database,
+}
+
+
+class IngestState:
+    """ Per-video stage status, saved atomically after every change """
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.videos = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.videos = json.load(f)
+
+    def status(self, video_name, stage):
+        return self.videos.get(video_name, {}).get(stage, {}).get('status')
+
+    def mark(self, video_name, stage, status, **info):
+        self.videos.setdefault(video_name, {})[stage] = dict(status=status, time=time.time(), **info)
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.videos, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class IngestPipeline:
+    """ Schedules the stage DAG over all videos on per-stage process pools """
+
+    def __init__(self, workers, queue_size=8, retry_failed=False, state=None, keyframe_options=None,
+                 metadata_options=None):
+        self.workers = workers
+        self.keyframe_options = keyframe_options or {}
+        self.metadata_options = metadata_options or {}
+        self.queue_size = queue_size
+        self.retry_failed = retry_failed
+        self.state = state or IngestState()
+        self.mp_context = multiprocessing.get_context('spawn') # CUDA and TensorFlow do not survive fork
+        self.pools = {stage: self._new_pool(stage) for stage in STAGES}
+        self.ready = {stage: deque() for stage in STAGES}
+        self.queued = set()
+        self.in_flight = {}
+        self.store = None
+
+        self.downstream = {stage: [s for s, deps in STAGES.items() if stage in deps] for stage in STAGES}
+
+    def _new_pool(self, stage):
+        return ProcessPoolExecutor(max_workers=self.workers[stage], mp_context=self.mp_context)
+
+    def _schedule(self, video_name):
+        """ Queue every stage of the video whose dependencies are finished """
+        for stage, deps in STAGES.items():
+            status = self.state.status(video_name, stage)
+            if status == 'done' or (status == 'failed' and not self.retry_failed):
+                continue
+            if (stage, video_name) in self.queued:
+                continue
+            if all(self.state.status(video_name, dep) == 'done' for dep in deps):
+                self.ready[stage].append(video_name)
+                self.queued.add((stage, video_name))
+
+    def _has_room(self, stage):
+        return all(len(self.ready[d]) < self.queue_size for d in self.downstream[stage])
+
+    def _submit(self, stage, video_name):
+        args = (video_name,)
+        kwargs = {}
+        if stage == 'embeddings':
+            args = (video_name, self._embedded_keyframes(video_name))
+        elif stage == 'keyframes':
+            kwargs = self.keyframe_options
+        elif stage == 'metadata':
+            kwargs = self.metadata_options
+        pool = self.pools[stage]
+        future = pool.submit(STAGE_FUNCS[stage], *args, **kwargs)
+        self.in_flight[future] = (stage, video_name, time.perf_counter(), pool)
+
+    def _embedded_keyframes(self, video_name):
+        """ Keyframes and frames of the video that an earlier, interrupted run already stored """
+        from utils.embedding_store import EmbeddingStore
+        if self.store is None:
+            self.store = EmbeddingStore()
+        return [name for name in _keyframe_names(video_name) + _frame_names(video_name) if name in self.store]
+
+    def _finish(self, future):
+        stage, video_name, start, pool = self.in_flight.pop(future)
+        self.queued.discard((stage, video_name))
+        seconds = round(time.perf_counter() - start, 2)
+        try:
+            result = future.result()
+            if stage == 'embeddings':
+                # The orchestrator is the only writer of the embedding store
+                shot_names, embeddings = result
+                self.store.append(shot_names, embeddings)
+            self.state.mark(video_name, stage, 'done', seconds=seconds)
+            print(f"[{stage}] {video_name} done in {seconds}s")
+            self._schedule(video_name)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and self.pools[stage] is pool:
+                # A crashed worker breaks the whole pool, start a fresh one
+                self.pools[stage] = self._new_pool(stage)
+            self.state.mark(video_name, stage, 'failed', error=''.join(
+                traceback.format_exception_only(type(e), e)).strip())
+            print(f"[{stage}] {video_name} failed: {e}")
+
+    def run(self, videos):
+        for video_name in videos:
+            self._schedule(video_name)
+
+        while self.in_flight or any(self.ready.values()):
+            # Downstream stages first, so queues drain before new work enters
+            for stage in reversed(list(STAGES)):
+                while (self.ready[stage] and self._has_room(stage)
+                       and sum(s == stage for s, _, _, _ in self.in_flight.values()) < self.workers[stage]):
+                    self._submit(stage, self.ready[stage].popleft())
+
+            if not self.in_flight:
+                break
+            done, _ = wait(list(self.in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                self._finish(future)
+
+        for pool in self.pools.values():
+            pool.shutdown()
+
+    def summary(self, videos):
+        counts = {stage: {'done': 0, 'failed': 0} for stage in STAGES}
+        for video_name in videos:
+            for stage in STAGES:
+                status = self.state.status(video_name, stage)
+                if status in ('done', 'failed'):
+                    counts[stage][status] += 1
+        for stage, c in counts.items():
+            print(f"{stage:<12} {c['done']:>6} done {c['failed']:>6} failed of {len(videos)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest videos: shots, keyframes, embeddings, metadata and DB")
+    parser.add_argument('--videos', nargs='*', help='video ids to ingest (default: all in data/videos)')
+    parser.add_argument('--keyframe-workers', type=int, default=2)
+    parser.add_argument('--embedding-workers', type=int, default=1)
+    parser.add_argument('--metadata-workers', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='videos waiting per stage before upstream stages pause')
+    parser.add_argument('--retry-failed', action='store_true', help='rerun stages that failed before')
+    parser.add_argument('--frames-per-shot', type=int, default=0,
+                        help='extra frames per shot embedded for multi-frame search')
+    parser.add_argument('--frame-sampling', choices=['uniform', 'change'], default='uniform')
+    parser.add_argument('--color-method', choices=['kmeans', 'histogram', 'minibatch'], default='kmeans',
+                        help='dominant color method, histogram and minibatch are fast approximations of kmeans')
+    parser.add_argument('--update-index', action='store_true',
+                        help='append new embeddings to the FAISS index when done')
+    args = parser.parse_args()
+
+    videos = args.videos or sorted(f.split('.')[0] for f in os.listdir(VIDEOS_DIR) if f.endswith('.mp4'))
+    workers = {
+        'keyframes': args.keyframe_workers,
+        'embeddings': args.embedding_workers,
+        'metadata': args.metadata_workers,
+        'database': 1, # SQLite has a single writer
+    }
+
+    start = time.perf_counter()
+    keyframe_options = {"frames_per_shot": args.frames_per_shot, "frame_sampling": args.frame_sampling}
+    pipeline = IngestPipeline(workers, args.queue_size, args.retry_failed, keyframe_options=keyframe_options,
+                              metadata_options={"color_method": args.color_method})
+    pipeline.run(videos)
+    print(f"Ingest finished in {time.perf_counter() - start:.1f}s")
+    pipeline.summary(videos)
+
+    # Columnar shot catalog that the app memory-maps
+    from utils.shot_catalog import build_catalog
+    build_catalog()
+
+    if args.update_index:
+        from db.faiss_CLIP import update_index
+        update_index()
+
+
+if __name__ == "__main__":
+    main()
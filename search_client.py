@@ -0,0 +1,37 @@
+import requests
+
+
+class SearchClient:
+    """ Client of search_server.py """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        self.timeout = timeout
+
+    def _post(self, path, payload):
+        response = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def filter_options(self):
+        response = self.session.get(f"{self.base_url}/filters", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def filter(self, objects, colors, brightness):
+        """ Return the matching video ids as a set """
+        result = self._post("/filter", {"objects": objects, "colors": colors, "brightness": brightness})
+        return set(result['video_ids'])
+
+    def filter_shots(self, objects, colors, brightness, videos):
+        """ Return the ids of the matching shots of the given videos as a set """
+        result = self._post("/filter", {"objects": objects, "colors": colors, "brightness": brightness,
+                                        "videos": list(videos)})
+        return set(result['shot_ids'])
+
+    def search(self, query, n_videos=100, objects=(), colors=(), brightness=()):
+        """ Return the most similar video ids and the best shot of each """
+        result = self._post("/search", {"query": query, "n_videos": n_videos, "objects": list(objects),
+                                        "colors": list(colors), "brightness": list(brightness)})
+        return result['video_ids'], result['shots']
@@ -0,0 +1,255 @@
+""" Long-lived search service with a JSON API, independent of Streamlit reruns.
+
+    The CLIP model, FAISS index and facet index are loaded once. Text queries
+    that arrive while the model is busy are collected into micro-batches, so
+    concurrent users share one encoder forward pass and one FAISS search
+    instead of queueing behind each other. Model and index are only used by
+    a single worker thread. A new catalog or FAISS index written by an
+    ingest is loaded in the background and swapped in between batches.
+    Repeated searches and filters are answered from a result cache keyed by
+    the snapshot version, without encoding or searching again.
+
+    Endpoints:
+        GET  /health
+        GET  /filters   -> {"objects": [...], "colors": [...], "brightness": [...]}
+        POST /filter    {"objects": [], "colors": [], "brightness": [], "videos": []}
+                        -> {"video_ids": [...], "shot_ids": [...]}
+                        shot_ids are only those of the given videos (e.g. one page)
+        POST /search    {"query": "...", "n_videos": 100, + the /filter fields}
+                        -> {"video_ids": [...], "shots": [...]}
+
+    Usage (from the main folder):
+        python search_server.py --port 8600
+        SEARCH_SERVER_URL=http://localhost:8600 streamlit run app.py
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+
+from utils.snapshots import SnapshotManager
+from utils.query_encoder import QueryEncoder
+from utils.CLIP_search import encode_queries
+from utils.query_cache import QueryEmbeddingCache, QUERY_CACHE_PATH, ResultCache, search_key, filter_key
+
+
+class SearchService:
+    """ Everything a query needs, loaded once and reloaded after an ingest (see utils/snapshots.py) """
+
+    def __init__(self, encoder_spec='torch', poll_seconds=10):
+        self.snapshots = SnapshotManager.load(poll_seconds=poll_seconds)
+        if poll_seconds:
+            self.snapshots.start()
+        self.encoder = QueryEncoder(encoder_spec).warm_up()
+        self.query_cache = QueryEmbeddingCache(disk_path=QUERY_CACHE_PATH)
+        # Final results keyed by the snapshot version, so a reload never serves stale ones
+        self.result_cache = ResultCache()
+
+    def filter_options(self):
+        facet_index = self.snapshots.current.facet_index
+        return {
+            "objects": facet_index.values('objects'),
+            "colors": facet_index.values('colors'),
+            "brightness": facet_index.values('brightness'),
+        }
+
+    def filter(self, objects=(), colors=(), brightness=(), videos=()):
+        snapshot = self.snapshots.current
+        key = filter_key(objects, colors, brightness, snapshot.version)
+        cached = self.result_cache.get(key)
+        if cached is None:
+            video_ids = sorted(snapshot.facet_index.matching_videos(objects, colors, brightness))
+            shot_mask = snapshot.facet_index.shot_mask(objects, colors, brightness)
+            cached = (video_ids, shot_mask)
+            # A bool per shot, about an eighth of an id
+            self.result_cache.put(key, cached, cost=len(video_ids) + len(shot_mask) // 8 + 1)
+        video_ids, shot_mask = cached
+        return {
+            "video_ids": video_ids,
+            "shot_ids": sorted(snapshot.facet_index.shot_ids_in_videos(shot_mask, videos)),
+        }
+
+    def search_batch(self, requests):
+        """ One encoder pass for all uncached queries, one FAISS call for the unfiltered ones """
+        # The whole batch runs on one snapshot, even if a newer one is swapped in meanwhile
+        snapshot = self.snapshots.current
+        keys = [search_key(r['query'], r['n_videos'], r['objects'], r['colors'], r['brightness'],
+                           snapshot.version) for r in requests]
+        results = [self.result_cache.get(key) for key in keys]
+
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+        query_embs = encode_queries([requests[i]['query'] for i in misses], self.encoder, self.query_cache)
+        row = {i: j for j, i in enumerate(misses)}
+
+        unfiltered = [i for i in misses if not _has_filters(requests[i])]
+        if unfiltered:
+            n_videos = max(requests[i]['n_videos'] for i in unfiltered)
+            batch_results = snapshot.search_engine.search_batch(query_embs[[row[i] for i in unfiltered]], n_videos)
+            for i, (video_ids, shots) in zip(unfiltered, batch_results):
+                n = requests[i]['n_videos']
+                results[i] = {"video_ids": video_ids[:n], "shots": shots[:n]}
+
+        for i in misses:
+            r = requests[i]
+            if results[i] is None:
+                shot_mask = snapshot.facet_index.shot_mask(r['objects'], r['colors'], r['brightness'])
+                video_ids, shots = snapshot.search_engine.search(query_embs[row[i]:row[i] + 1], r['n_videos'],
+                                                             shot_mask=shot_mask)
+                results[i] = {"video_ids": video_ids, "shots": shots}
+            self.result_cache.put(keys[i], results[i], cost=len(results[i]['shots']) + 1)
+        return results
+
+
+def _has_filters(request):
+    return bool(request['objects'] or request['colors'] or request['brightness'])
+
+
+class QueryBatcher:
+    """ Collects concurrent search requests into micro-batches for one worker thread """
+
+    def __init__(self, service, max_batch=32, max_wait_ms=5):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def search(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # Wait a few milliseconds for more queries unless the batch is full
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.service.search_batch,
+                                                     [request for request, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            print(f"Searched {len(batch)} queries in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+def parse_filters(body):
+    return {
+        "objects": list(body.get('objects') or []),
+        "colors": list(body.get('colors') or []),
+        "brightness": list(body.get('brightness') or []),
+    }
+
+
+class JsonHandler(tornado.web.RequestHandler):
+
+    def initialize(self, service, batcher):
+        self.service = service
+        self.batcher = batcher
+
+    def body_json(self):
+        try:
+            return json.loads(self.request.body or b'{}')
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Body is not valid JSON")
+
+    def write_json(self, data):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(data))
+
+
+class HealthHandler(JsonHandler):
+
+    def get(self):
+        snapshot = self.service.snapshots.current
+        self.write_json({"status": "ok", "shots": len(snapshot.catalog),
+                         "search": snapshot.search_engine is not None,
+                         "encoder_ready": self.service.encoder.ready,
+                         "snapshot_version": str(snapshot.version),
+                         "snapshot_reloads": self.service.snapshots.reloads,
+                         "result_cache": self.service.result_cache.stats()})
+
+
+class FiltersHandler(JsonHandler):
+
+    def get(self):
+        self.write_json(self.service.filter_options())
+
+
+class FilterHandler(JsonHandler):
+
+    def post(self):
+        body = self.body_json()
+        self.write_json(self.service.filter(videos=list(body.get('videos') or []), **parse_filters(body)))
+
+
+class SearchHandler(JsonHandler):
+
+    async def post(self):
+        if self.service.snapshots.current.search_engine is None:
+            raise tornado.web.HTTPError(503, reason="FAISS index is not built")
+        body = self.body_json()
+        query = body.get('query', '').strip()
+        if not query:
+            raise tornado.web.HTTPError(400, reason="Missing query")
+
+        request = dict(query=query, n_videos=int(body.get('n_videos', 100)), **parse_filters(body))
+        self.write_json(await self.batcher.search(request))
+
+
+def make_app(service, batcher):
+    args = dict(service=service, batcher=batcher)
+    return tornado.web.Application([
+        (r"/health", HealthHandler, args),
+        (r"/filters", FiltersHandler, args),
+        (r"/filter", FilterHandler, args),
+        (r"/search", SearchHandler, args),
+    ])
+
+
+async def serve(port, max_batch, max_wait_ms, encoder_spec='torch', poll_seconds=10):
+    service = SearchService(encoder_spec, poll_seconds)
+    batcher = QueryBatcher(service, max_batch, max_wait_ms)
+    make_app(service, batcher).listen(port)
+    print(f"Search server listening on port {port}")
+    await batcher.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search server for the video search app")
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--max-batch', type=int, default=32, help='queries per encoder/FAISS batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5,
+                        help='how long a query waits for others to join its batch')
+    parser.add_argument('--encoder', default='torch',
+                        help='query encoder: torch, torch-int8, torchscript[-int8] or onnx (see utils/query_encoder.py)')
+    parser.add_argument('--poll-seconds', type=float, default=10,
+                        help='how often to check for a new catalog or index after an ingest, 0 disables reloading')
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.port, args.max_batch, args.max_wait_ms, args.encoder, args.poll_seconds))
+
+
+if __name__ == "__main__":
+    main()
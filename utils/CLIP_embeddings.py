@@ -1,62 +1,184 @@
+""" Extract CLIP image embeddings for the keyframes into the embedding store.
+
+    Keyframes are decoded and preprocessed by a pool of DataLoader workers
+    while the model runs batched forward passes. Shots already in the store
+    are skipped, so an interrupted run can simply be restarted.
+
+    Usage (from the main folder):
+        python -m utils.CLIP_embeddings --batch-size 64 --num-workers 8 --threads 8
+        python -m utils.CLIP_embeddings --videos 00001 00002
+        python -m utils.CLIP_embeddings --keyframes-dir data/processed/shot_frames   # extra shot frames
+"""
+import argparse
 import os
-import sys
+import time
+
+import numpy as np
 import torch
-import transformers
 from PIL import Image
-import numpy as np
+from torch.utils.data import DataLoader, Dataset
 from transformers import CLIPProcessor, CLIPModel
 
-# Check for CUDA availability
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-# Load CLIP model and processor
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+from utils.embedding_store import EmbeddingStore
 
-# Move model to GPU
-model.to(device)
-
-# Define keyframe path from video and shot names
-videos_list = sorted([f for f in os.listdir('data/videos') if f.endswith('.mp4')])
+MODEL_ID = "openai/clip-vit-base-patch32"
 
 # Directory containing keyframes
-keyframes_dir = 'data/processed/keyframes'
-
-
-# Load and preprocess image
-def extract_clip_embeddings(shot_name):
-    """ Arg: shot name video_name_shot_20.jpg string """
-    image = Image.open(f'data/processed/keyframes/{shot_name}')
-    inputs = processor(images=image, return_tensors="pt")
-
-    inputs = inputs.to(device)
+KEYFRAMES_DIR = 'data/processed/keyframes'
 
-    with torch.no_grad():
-        # Extract CLIP embeddings
-        image_features = model.get_image_features(**inputs)
-        # Normalize embeddings
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
 
-    # Convert to numpy
-    embeddings_np = image_features.cpu().numpy()
+def load_clip_image_model(threads=None):
+    """ Load CLIP model, processor and device for image embedding """
+    if threads:
+        torch.set_num_threads(threads)
 
-    # Define output path for embeddings
-    output_path = f'data/processed/embeddings/{shot_name}_embeddings.npy'
+    # Check for CUDA availability
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # Save embeddings
-    np.save(output_path, embeddings_np)
+    model = CLIPModel.from_pretrained(MODEL_ID)
+    processor = CLIPProcessor.from_pretrained(MODEL_ID)
+    model.to(device)
+    model.eval()
+    return model, processor, device
 
 
+class KeyframeDataset(Dataset):
+    """ Decodes and preprocesses one keyframe per item, runs inside DataLoader workers """
 
-### TAKE ONLY 5 F VIDEOS FOR NOW
-for video_file in videos_list[100:]:
-    video_name = video_file.split('.')[0]
+    def __init__(self, shot_names, processor, keyframes_dir=KEYFRAMES_DIR):
+        self.shot_names = shot_names
+        self.processor = processor
+        self.keyframes_dir = keyframes_dir
 
-    # Get all shots from the video
-    keyframes = [f for f in os.listdir(keyframes_dir) if f.startswith(video_name)]
+    def __len__(self):
+        return len(self.shot_names)
 
-    for shot in keyframes:
-        extract_clip_embeddings(shot)
+    def __getitem__(self, idx):
+        shot_name = self.shot_names[idx]
+        with Image.open(os.path.join(self.keyframes_dir, shot_name)) as image:
+            inputs = self.processor(images=image.convert('RGB'), return_tensors="pt")
+        return shot_name, inputs['pixel_values'][0]
 
-    print(f"Extracted embeddings for shots in {video_name}")
-        
\ No newline at end of file
+
+def _worker_init(_):
+    # One thread per decode worker, the model gets the rest
+    torch.set_num_threads(1)
+
+
+def extract_clip_embeddings(shot_names, model, processor, device, store,
+                            batch_size=64, num_workers=4, flush_rows=4096,
+                            keyframes_dir=KEYFRAMES_DIR):
+    """ Embed keyframes in batches and append them to the store.
+
+        Arg: shot names like "00001_shot_20.jpg". Rows are flushed to the
+        store every flush_rows embeddings, which is what makes runs resumable.
+    """
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs = {"prefetch_factor": 4}
+
+    loader = DataLoader(
+        KeyframeDataset(shot_names, processor, keyframes_dir),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        worker_init_fn=_worker_init,
+        pin_memory=device.type == 'cuda',
+        **loader_kwargs,
+    )
+
+    pending_names, pending_embeddings = [], []
+    done = 0
+    start = time.perf_counter()
+
+    with torch.inference_mode():
+        for batch_names, pixel_values in loader:
+            image_features = model.get_image_features(pixel_values=pixel_values.to(device, non_blocking=True))
+            # Normalize embeddings
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+
+            pending_names.extend(batch_names)
+            pending_embeddings.append(image_features.cpu().numpy())
+
+            if len(pending_names) >= flush_rows:
+                store.append(pending_names, np.concatenate(pending_embeddings))
+                done += len(pending_names)
+                pending_names, pending_embeddings = [], []
+                rate = done / (time.perf_counter() - start)
+                print(f"Embedded {done}/{len(shot_names)} keyframes ({rate:.1f} images/s)")
+
+    if pending_names:
+        store.append(pending_names, np.concatenate(pending_embeddings))
+        done += len(pending_names)
+
+    return done
+
+
+# Model of an ingest worker process, loaded on first use
+_worker_model = None
+
+
+def embed_keyframes(shot_names, batch_size=64, keyframes_dir=KEYFRAMES_DIR):
+    """ Embed keyframes in the calling process without writing them.
+
+        Used by ingest.py workers; the orchestrator is the only store writer.
+        Returns (shot_names, embeddings).
+    """
+    global _worker_model
+    if _worker_model is None:
+        _worker_model = load_clip_image_model()
+    model, processor, device = _worker_model
+
+    dataset = KeyframeDataset(shot_names, processor, keyframes_dir)
+    embeddings = [np.empty((0, model.config.projection_dim), dtype='float32')]
+
+    with torch.inference_mode():
+        for start in range(0, len(dataset), batch_size):
+            pixel_values = torch.stack([dataset[i][1] for i in range(start, min(start + batch_size, len(dataset)))])
+            image_features = model.get_image_features(pixel_values=pixel_values.to(device))
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+            embeddings.append(image_features.cpu().numpy())
+
+    return shot_names, np.concatenate(embeddings)
+
+
+def keyframes_to_embed(store, videos=None, keyframes_dir=KEYFRAMES_DIR):
+    """ Keyframe files that are not in the store yet, optionally only for some videos """
+    keyframes = sorted(f for f in os.listdir(keyframes_dir) if f.endswith('.jpg'))
+    if videos:
+        prefixes = tuple(f"{video_name}_" for video_name in videos)
+        keyframes = [f for f in keyframes if f.startswith(prefixes)]
+    return [f for f in keyframes if f not in store]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract CLIP embeddings for keyframes")
+    parser.add_argument('--keyframes-dir', default=KEYFRAMES_DIR)
+    parser.add_argument('--videos', nargs='*', help='only embed keyframes of these video ids')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count() // 2 or 1,
+                        help='processes decoding and preprocessing keyframes')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch intra-op threads for the model')
+    parser.add_argument('--flush-rows', type=int, default=4096,
+                        help='embeddings buffered before each store append')
+    args = parser.parse_args()
+
+    store = EmbeddingStore()
+    shot_names = keyframes_to_embed(store, args.videos, args.keyframes_dir)
+    if not shot_names:
+        print("All keyframes are already embedded")
+        return
+    print(f"{len(shot_names)} keyframes to embed, {len(store)} already in the store")
+
+    model, processor, device = load_clip_image_model(args.threads)
+
+    start = time.perf_counter()
+    done = extract_clip_embeddings(shot_names, model, processor, device, store,
+                                   args.batch_size, args.num_workers, args.flush_rows,
+                                   args.keyframes_dir)
+    elapsed = time.perf_counter() - start
+    print(f"Extracted {done} embeddings in {elapsed:.1f}s ({done / elapsed:.1f} images/s)")
+
+
+if __name__ == "__main__":
+    main()
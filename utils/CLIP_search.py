@@ -1,86 +1,331 @@
 import numpy as np
-import torch
 import faiss
-from transformers import CLIPProcessor, CLIPModel
 import os
+import json
 
-def load_clip_model():
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-    model.eval()
-    return model, processor, device
+from utils.query_cache import QueryEmbeddingCache, normalize_query
+from db.faiss_CLIP import shot_key_from_frame_name
 
-def encode_query(query, processor, model, device):
+FAISS_INDEX_PATH = 'db/faiss/faiss_clip.index'
+SHOT_NAMES_PATH = 'db/faiss/shot_names.npy'
+INDEX_PARAMS_PATH = 'db/faiss/faiss_clip.json'
+
+# Filters matching at least this fraction of the index are applied after the search
+POST_FILTER_SELECTIVITY = 0.25
+
+# IDSelector search parameters need faiss >= 1.7.3
+HAS_SEARCH_PARAMS = hasattr(faiss, 'SearchParameters')
+
+# Vectors reconstructed at once when scoring a filtered subset exactly
+SUBSET_CHUNK = 65536
+
+# Softmax pooling temperature, in units of cosine similarity
+POOLING_TEMPERATURE = 0.01
+
+
+# Default in-memory query embedding cache, used when a caller passes none. The app and the search
+# server pass their own QueryEmbeddingCache with a disk tier
+query_cache = QueryEmbeddingCache()
+
+
+def encode_queries(queries, encoder, cache=None, batch_size=64):
+    """ Encode many queries with a QueryEncoder, returns a (len(queries), dim) float32 matrix.
+
+        Queries are normalized and deduplicated first, cached embeddings are
+        reused and only the rest goes through the text encoder in batches.
+    """
+    cache = query_cache if cache is None else cache
+    normalized = [normalize_query(q) for q in queries]
+
+    embeddings = {}
+    for query in dict.fromkeys(normalized):
+        embedding = cache.get(encoder.cache_id, query)
+        if embedding is not None:
+            embeddings[query] = embedding
+    missing = [query for query in dict.fromkeys(normalized) if query not in embeddings]
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for query, embedding in zip(batch, encoder.encode(batch)):
+            cache.put(encoder.cache_id, query, embedding)
+            embeddings[query] = embedding
+
+    if not normalized:
+        return encoder.encode([])
+    return np.stack([embeddings[query] for query in normalized])
+
+
+def encode_query(query, encoder, cache=None):
     """ Encode users query with CLIP embeddings"""
-    with torch.no_grad():
-        inputs = processor(text=[query], return_tensors="pt", padding=True).to(device)
-        text_features = model.get_text_features(**inputs)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        return text_features.cpu().numpy().astype('float32')
-    
-
-def load_search_components():
-    """Load CLIP model and FAISS index for search functionality"""
-    # Load CLIP model
-    model, processor, device = load_clip_model()
-    
-    # Load FAISS index and shot names
-    faiss_index_path = 'db/faiss/faiss_clip.index'
-    shot_names_path = 'db/faiss/shot_names.npy'
-    
-    if os.path.exists(faiss_index_path) and os.path.exists(shot_names_path):
-        faiss_index = faiss.read_index(faiss_index_path)
-        shot_names = np.load(shot_names_path)
-        return model, processor, device, faiss_index, shot_names
-    else:
-        return model, processor, device, None, None
-
-
-def search_clip_index(query_emb, faiss_index, shot_names, all_shots):
-    """ Return the most similar videos_id and ordered shot list """
-    D, I = faiss_index.search(query_emb, len(shot_names))
-    
-    # Create mapping from FAISS shot names to database shots
-    # FAISS format: "00001_shot_0.jpg"
-    # DB format: shot_name="shot_0", video_id="00001"
-    shot_name_to_shot = {}
-    for shot in all_shots:
-        shot_name = shot.get('shot_name')  # e.g., "shot_0"
-        video_id = shot.get('video_id')    # e.g., "00001"
-        if shot_name and video_id:
-            # Create the FAISS format key: "00001_shot_0.jpg"
-            faiss_key = f"{video_id}_{shot_name}.jpg"
-            shot_name_to_shot[faiss_key] = shot
-    
-    # Check how many shots match
-    matching_shots = sum(1 for name in shot_names if name in shot_name_to_shot)
-    print(f"Matching shots: {matching_shots} out of {len(shot_names)}")
-    
-    # Create shot index to video mapping
-    shot_to_video = {}
-    for idx in range(len(shot_names)):
-        shot_name = shot_names[idx]  # e.g., "00001_shot_0.jpg"
-        shot_data = shot_name_to_shot.get(shot_name)
-        if shot_data and 'video_id' in shot_data:
-            shot_to_video[idx] = shot_data['video_id']
+    return encode_queries([query], encoder, cache)
+
+
+class ClipSearchEngine:
+    """ FAISS index together with a FAISS id -> (video code, catalog row) lookup table.
+
+        The table is built once from the FAISS shot names and the shot
+        catalog, so a query only touches the k rows FAISS returns.
+
+        An index can hold several frames per shot ("00001_shot_0_f2.jpg"),
+        which all map to the shot's row. Their scores among the retrieved
+        neighbours are pooled into one shot score: 'max', 'mean' or
+        'softmax' (mean weighted by the softmax of the scores).
+
+        mean_vectors_per_shot and max_vectors_per_shot are saved with the
+        index by db/faiss_CLIP.py; for older indexes they are counted here.
+    """
+
+    def __init__(self, faiss_index, shot_names, catalog, pooling='max', mean_vectors_per_shot=None,
+                 max_vectors_per_shot=None):
+        self.index = faiss_index
+        self.shot_names = shot_names
+        self.catalog = catalog
+        self.video_ids = catalog.videos
+        self.pooling = pooling
+
+        # FAISS format: "00001_shot_0.jpg", extra frames "00001_shot_0_f2.jpg"
+        # DB format: shot_name="shot_0", video_id="00001"
+        shot_key_to_row = {
+            f"{catalog.videos[video]}_{shot_name}.jpg": row
+            for row, (video, shot_name) in enumerate(zip(catalog.video.tolist(), catalog.shot_names()))
+            if shot_name
+        }
+
+        # Compact array-backed table, -1 marks ids without DB data
+        self.row_shot = np.array([shot_key_to_row.get(shot_key_from_frame_name(str(shot_key)), -1)
+                                  for shot_key in shot_names], dtype=np.int64)
+        self.row_video = np.full(len(shot_names), -1, dtype=np.int32)
+        valid = self.row_shot >= 0
+        self.row_video[valid] = catalog.video[self.row_shot[valid]]
+
+        n_shots = len(np.unique(self.row_shot[valid]))
+        if mean_vectors_per_shot is None:
+            mean_vectors_per_shot = valid.sum() / n_shots if n_shots else 1
+            max_vectors_per_shot = int(np.bincount(self.row_shot[valid]).max()) if n_shots else 1
+
+        # Neighbours are counted in vectors, so k grows with the typical frames per shot, not the
+        # largest; a few shots with an extra frame leave k as it is
+        self.vectors_per_shot = max(1, int(round(mean_vectors_per_shot)))
+        self.pool_frames = (max_vectors_per_shot or 1) > 1
+
+        matching_shots = int(valid.sum())
+        print(f"Matching shots: {matching_shots} out of {len(shot_names)} "
+              f"({n_shots} shots, {matching_shots / max(n_shots, 1):.1f} vectors per shot)")
+
+    def _default_k(self, n_videos):
+        return max(4 * n_videos, 64) * self.vectors_per_shot
+
+    def search(self, query_emb, n_videos=100, k=None, shot_mask=None):
+        """ Return up to n_videos video ids and the best shot of each.
+
+            shot_mask is an optional bool mask over catalog rows (e.g. from
+            FacetIndex.shot_mask); only matching shots are ranked then.
+            Loose filters are applied after the FAISS search, selective
+            ones restrict the search itself, and either way the result
+            holds n_videos videos if that many have a matching shot.
+        """
+        ntotal = self.index.ntotal
+        if ntotal == 0:
+            return [], []
+        k = k or self._default_k(n_videos)
+
+        if shot_mask is None:
+            return self._search_widening(query_emb, n_videos, k)
+
+        eligible = self.row_shot >= 0
+        eligible[eligible] = shot_mask[self.row_shot[eligible]]
+        ids = np.flatnonzero(eligible)
+        if len(ids) == 0:
+            return [], []
+
+        # Post-filtering needs about k / selectivity neighbours to keep k of them
+        selectivity = len(ids) / ntotal
+        if selectivity >= POST_FILTER_SELECTIVITY:
+            return self._search_widening(query_emb, n_videos, int(k / selectivity), eligible=eligible)
+
+        wanted = min(n_videos, len(np.unique(self.row_video[ids])))
+        if HAS_SEARCH_PARAMS and not self._is_hnsw():
+            sel = faiss.IDSelectorBatch(ids)
+            result = self._search_widening(query_emb, n_videos, k, eligible=eligible,
+                                           params=self._search_params(sel), k_max=len(ids))
+            # IVF only scores the probed lists, fall back to exact scoring if that was not enough
+            if len(result[0]) >= wanted:
+                return result
+        return self._search_subset(query_emb, n_videos, ids)
+
+    def search_batch(self, query_embs, n_videos=100, k=None):
+        """ Unfiltered search of many queries with one FAISS call.
+
+            Queries that do not reach n_videos distinct videos within k
+            neighbours are widened one by one.
+        """
+        ntotal = self.index.ntotal
+        if ntotal == 0:
+            return [([], []) for _ in range(len(query_embs))]
+        k = min(k or self._default_k(n_videos), ntotal)
+
+        D, I = self.index.search(np.ascontiguousarray(query_embs, dtype='float32'), k)
+        results = []
+        for i, rows in enumerate(I):
+            hits = self._first_hits(rows[rows >= 0], D[i][rows >= 0])
+            if len(hits[-1]) < n_videos and k < ntotal:
+                results.append(self._search_widening(query_embs[i:i + 1], n_videos, k * 4))
+            else:
+                results.append(self._results(*hits, n_videos))
+        return results
+
+    def _search_widening(self, query_emb, n_videos, k, eligible=None, params=None, k_max=None):
+        """ Search with k neighbours and widen k until enough distinct videos are found """
+        k_max = min(k_max or self.index.ntotal, self.index.ntotal)
+        k = min(k, k_max)
+        while True:
+            if params is None:
+                D, I = self.index.search(query_emb, k)
+            else:
+                D, I = self.index.search(query_emb, k, params=params)
+            found = I[0] >= 0
+            rows, scores = I[0][found], D[0][found]
+            if eligible is not None:
+                keep = eligible[rows]
+                rows, scores = rows[keep], scores[keep]
+            hits = self._first_hits(rows, scores)
+
+            if len(hits[-1]) >= n_videos or k >= k_max:
+                break
+            k = min(k * 4, k_max)
+
+        return self._results(*hits, n_videos)
+
+    def _search_subset(self, query_emb, n_videos, ids):
+        """ Exact scores of the given FAISS ids only """
+        scores = np.empty(len(ids), dtype='float32')
+        for start in range(0, len(ids), SUBSET_CHUNK):
+            scores[start:start + SUBSET_CHUNK] = self._reconstruct(ids[start:start + SUBSET_CHUNK]) @ query_emb[0]
+        order = np.argsort(-scores, kind='stable')
+        return self._results(*self._first_hits(ids[order], scores[order]), n_videos)
+
+    def _first_hits(self, rows, scores):
+        shots = self.row_shot[rows]
+        videos = self.row_video[rows]
+        valid = shots >= 0
+        shots, videos, scores = shots[valid], videos[valid], scores[valid]
+        if self.pool_frames:
+            shots, videos, scores = self._pool(shots, videos, scores)
+
+        # First hit of every video, kept in ranking order
+        _, first_hits = np.unique(videos, return_index=True)
+        first_hits.sort()
+        return videos, shots, scores, first_hits
+
+    def _pool(self, shots, videos, scores):
+        """ One score per shot from the scores of its retrieved frames, ranked again """
+        unique_shots, first, inverse = np.unique(shots, return_index=True, return_inverse=True)
+        best = np.full(len(unique_shots), -np.inf, dtype='float32')
+        np.maximum.at(best, inverse, scores)
+
+        if self.pooling == 'mean':
+            pooled = np.bincount(inverse, weights=scores) / np.bincount(inverse)
+        elif self.pooling == 'softmax':
+            weights = np.exp((scores - best[inverse]) / POOLING_TEMPERATURE)
+            pooled = np.bincount(inverse, weights=weights * scores) / np.bincount(inverse, weights=weights)
         else:
-            print(f"Warning: No shot data found for shot_name: {shot_name}")
-    
-    seen_videos = set()
-    ordered_video_ids = []
-    ordered_shots = []
-    
-    for idx in I[0]:
-        video_id = shot_to_video.get(idx)
-        shot_name = shot_names[idx]
-        shot_data = shot_name_to_shot.get(shot_name)
-        
-        if video_id and video_id not in seen_videos and shot_data:
-            ordered_video_ids.append(video_id)
-            ordered_shots.append(shot_data)
-            seen_videos.add(video_id)
-            
+            pooled = best
+
+        order = np.argsort(-pooled, kind='stable')
+        return unique_shots[order], videos[first][order], pooled[order].astype('float32')
+
+    def _results(self, videos, shots, scores, first_hits, n_videos):
+        """ Video ids and their best shots with the similarity as 'score' """
+        first_hits = first_hits[:n_videos]
+        ordered_video_ids = [self.video_ids[v] for v in videos[first_hits]]
+        ordered_shots = [dict(self.catalog.shot(row), score=float(score))
+                         for row, score in zip(shots[first_hits], scores[first_hits])]
+        return ordered_video_ids, ordered_shots
+
+    def _is_hnsw(self):
+        # Graph search with a selector loses recall on selective filters, score those exactly
+        index = self.index.index if isinstance(self.index, faiss.IndexIDMap) else self.index
+        return isinstance(faiss.downcast_index(index), faiss.IndexHNSW)
+
+    def _search_params(self, sel):
+        """ Selector together with the index's own search-time parameters """
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            return faiss.SearchParametersIVF(sel=sel, nprobe=ivf.nprobe)
+        return faiss.SearchParameters(sel=sel)
+
+    def _reconstruct(self, ids):
+        """ Stored vectors of ids, IVF indexes got their direct map in load_faiss_index """
+        if hasattr(self.index, 'reconstruct_batch'):
+            return self.index.reconstruct_batch(ids)
+        return np.vstack([self.index.reconstruct(int(i)) for i in ids])
+
+
+def load_index_params():
+    """ Parameters db/faiss_CLIP.py saved next to the index, {} for older indexes """
+    if not os.path.exists(INDEX_PARAMS_PATH):
+        return {}
+    with open(INDEX_PARAMS_PATH, 'r') as f:
+        return json.load(f)
+
+
+def index_version():
+    """ Version id db/faiss_CLIP.py writes with every saved index, None if there is no index """
+    if not (os.path.exists(FAISS_INDEX_PATH) and os.path.exists(SHOT_NAMES_PATH)):
+        return None
+    # Indexes saved before versioning: the file's modification time
+    return load_index_params().get('version') or str(os.stat(FAISS_INDEX_PATH).st_mtime_ns)
+
+
+def load_faiss_index(mmap=False):
+    """ Read whichever index type db/faiss_CLIP.py built and apply its search-time parameters.
+
+        With mmap the index file is memory-mapped (faiss.IO_FLAG_MMAP) instead
+        of read into memory, so processes and index versions share the page cache.
+    """
+    faiss_index = None
+    if mmap:
+        try:
+            faiss_index = faiss.read_index(FAISS_INDEX_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            pass # index type without mmap support
+    if faiss_index is None:
+        faiss_index = faiss.read_index(FAISS_INDEX_PATH)
+
+    # Selective filters score their shots with reconstruct, which IVF indexes only support with a
+    # direct map. It is built here, before the index is shared by query threads
+    ivf = faiss.try_extract_index_ivf(faiss_index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+
+    index_params = load_index_params()
+    if index_params:
+        if index_params.get('search_params'):
+            faiss.ParameterSpace().set_index_parameters(faiss_index, index_params['search_params'])
+        print(f"Loaded {index_params.get('index_spec', 'Flat')} index "
+              f"({faiss_index.ntotal} vectors, {index_params.get('search_params') or 'default params'})")
+    return faiss_index
+
+
+def load_search_index(mmap=False):
+    """ FAISS index and its id-ordered shot names, None if the index is not built yet """
+    if not (os.path.exists(FAISS_INDEX_PATH) and os.path.exists(SHOT_NAMES_PATH)):
+        return None
+    return load_faiss_index(mmap), np.load(SHOT_NAMES_PATH)
+
+
+def make_search_engine(catalog, search_index):
+    """ ClipSearchEngine over a load_search_index() result, None without an index """
+    if search_index is None:
+        return None
+    faiss_index, shot_names = search_index
+    params = load_index_params()
+    return ClipSearchEngine(faiss_index, shot_names, catalog, params.get('pooling') or 'max',
+                            params.get('mean_vectors_per_shot'), params.get('max_vectors_per_shot'))
+
+
+def search_clip_index(query_emb, search_engine, n_videos=100, shot_mask=None):
+    """ Return the most similar videos_id and ordered shot list """
+    ordered_video_ids, ordered_shots = search_engine.search(query_emb, n_videos=n_videos, shot_mask=shot_mask)
     print(f"Final results: {len(ordered_video_ids)} videos, {len(ordered_shots)} shots")
-    return ordered_video_ids, ordered_shots
\ No newline at end of file
+    return ordered_video_ids, ordered_shots
@@ -1,23 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from ultralytics import YOLO
 import torch
 import cv2
 
+MODEL_PATH = 'models/yolov8n.pt'
+
+# The YOLO model is loaded on first use
+_model = None
+
+
+def get_model():
+    global _model
+    if _model is None:
+        _model = YOLO(MODEL_PATH)
+    return _model
 
-model = YOLO('models/yolov8n.pt')
 
 def get_objects(input_path):
     """Returns list of unique object classes detected
     in the keyframe """
+    return list(get_objects_batch([input_path])[0])
+
+
+def get_objects_batch(input_paths, batch_size=32, imgsz=640, conf=0.25, decode_workers=8):
+    """ Detect objects in many keyframes with batched YOLO inference.
+
+        Keyframes are decoded on a thread pool, one batch ahead of the model.
+        Returns one dict {class_name: highest confidence} per input path,
+        empty for images that cannot be read.
+    """
+    model = get_model()
+    batches = [input_paths[i:i + batch_size] for i in range(0, len(input_paths), batch_size)]
+    detections = []
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+        next_frames = [pool.submit(cv2.imread, path) for path in batches[0]] if batches else []
 
-    frame = cv2.imread(input_path)
+        for batch_idx in range(len(batches)):
+            frames = [future.result() for future in next_frames]
+            # Prefetch the next batch while YOLO runs on this one
+            if batch_idx + 1 < len(batches):
+                next_frames = [pool.submit(cv2.imread, path) for path in batches[batch_idx + 1]]
 
-    results = model(frame)
-    detected_classes = set()
+            readable = [frame for frame in frames if frame is not None]
+            results = iter(model(readable, imgsz=imgsz, conf=conf, verbose=False) if readable else [])
 
-    for result in results:
-        if result.boxes is not None:
-            for box in result.boxes:
-                class_name = model.names[int(box.cls)]
-                detected_classes.add(class_name)
+            for frame in frames:
+                objects = {}
+                if frame is not None:
+                    result = next(results)
+                    if result.boxes is not None:
+                        for cls, score in zip(result.boxes.cls.tolist(), result.boxes.conf.tolist()):
+                            class_name = model.names[int(cls)]
+                            objects[class_name] = max(objects.get(class_name, 0.0), round(score, 4))
+                detections.append(objects)
 
-    return list(detected_classes)
\ No newline at end of file
+    return detections
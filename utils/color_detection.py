@@ -1,12 +1,42 @@
+""" Dominant color and brightness of keyframes.
+
+    Methods:
+        kmeans     KMeans with 5 clusters over every pixel (original, slow)
+        minibatch  MiniBatchKMeans over a downsampled image
+        histogram  mode of a coarse HSV histogram over a downsampled image (fast)
+
+    Compare a fast method against kmeans on a sample of keyframes with:
+        python -m utils.color_detection --agreement --method histogram --sample 500
+"""
+import argparse
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+KEYFRAMES_DIR = 'data/processed/keyframes'
+
+# Longest image side used by the fast methods
+FAST_MAX_SIDE = 96
 
+# HSV histogram bins, OpenCV hue is 0-179, saturation and value 0-255
+H_BINS, S_BINS, V_BINS = 18, 4, 4
 
-def get_dominant_color(image_path, k=5):
-    """ Extract dominant colors using KMeans clustering"""
+
+def get_dominant_color(image_path, k=5, method='kmeans'):
+    """ Extract dominant color name and brightness of an image """
     # Load image
     image = cv2.imread(image_path)
+    if method == 'histogram':
+        return get_dominant_color_histogram(image)
+    if method == 'minibatch':
+        return get_dominant_color_minibatch(image, k)
+
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
     # Convert to HSV
@@ -36,6 +66,59 @@ def get_dominant_color(image_path, k=5):
     return mapped_color, brightness
 
 
+def downsample(image, max_side=FAST_MAX_SIDE):
+    """ Shrink the image so its longest side is at most max_side pixels """
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def get_dominant_color_histogram(image, max_side=FAST_MAX_SIDE):
+    """ Dominant color as the mean HSV of the most populated histogram bin.
+
+        Vectorized replacement for KMeans: one bincount over a downsampled image.
+    """
+    hsv_image = cv2.cvtColor(downsample(image, max_side), cv2.COLOR_BGR2HSV)
+    pixels = hsv_image.reshape((-1, 3)).astype(np.int32)
+
+    bins = ((pixels[:, 0] * H_BINS // 180) * S_BINS * V_BINS
+            + (pixels[:, 1] * S_BINS // 256) * V_BINS
+            + pixels[:, 2] * V_BINS // 256)
+    counts = np.bincount(bins, minlength=H_BINS * S_BINS * V_BINS)
+    most_dominant_hsv = pixels[bins == counts.argmax()].mean(axis=0)
+
+    return map_hsv_to_color(most_dominant_hsv), get_image_brightness(hsv_image)
+
+
+def get_dominant_color_minibatch(image, k=5, max_side=FAST_MAX_SIDE):
+    """ Same clustering as get_dominant_color, on a downsampled image with MiniBatchKMeans """
+    hsv_image = cv2.cvtColor(downsample(image, max_side), cv2.COLOR_BGR2HSV)
+    data = np.float32(hsv_image.reshape((-1, 3)))
+
+    kmeans = MiniBatchKMeans(n_clusters=k, random_state=42, n_init=3, batch_size=1024)
+    labels = kmeans.fit_predict(data)
+    counts = np.bincount(labels, minlength=k)
+    most_dominant_hsv = kmeans.cluster_centers_[counts.argmax()]
+
+    return map_hsv_to_color(most_dominant_hsv), get_image_brightness(hsv_image)
+
+
+def _dominant_color_job(args):
+    image_path, method = args
+    return get_dominant_color(image_path, method=method)
+
+
+def get_dominant_colors(image_paths, method='kmeans', workers=None, chunksize=16):
+    """ Batch API: (color, brightness) for many keyframes, on a process pool if workers > 1 """
+    jobs = [(image_path, method) for image_path in image_paths]
+    if not workers or workers <= 1:
+        return [_dominant_color_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_dominant_color_job, jobs, chunksize=chunksize))
+
+
 def map_hsv_to_color(hsv):
     """ Map HSV color to basic color name """
     h, s, v = hsv
@@ -85,3 +168,48 @@ def get_image_brightness(hsv_image):
         return "Medium"
     else:
         return "Bright"
+
+
+def agreement_report(image_paths, method='histogram', workers=None):
+    """ Compare a fast method against the original KMeans on the same keyframes """
+    start = time.perf_counter()
+    reference = get_dominant_colors(image_paths, 'kmeans', workers)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast = get_dominant_colors(image_paths, method, workers)
+    fast_time = time.perf_counter() - start
+
+    n = len(image_paths)
+    color_agreement = sum(r[0] == f[0] for r, f in zip(reference, fast)) / n
+    brightness_agreement = sum(r[1] == f[1] for r, f in zip(reference, fast)) / n
+    disagreements = Counter((r[0], f[0]) for r, f in zip(reference, fast) if r[0] != f[0])
+
+    print(f"{n} keyframes, kmeans vs {method}")
+    print(f"time               {reference_time:8.2f}s vs {fast_time:8.2f}s ({reference_time / fast_time:.1f}x)")
+    print(f"color agreement    {color_agreement:8.2%}")
+    print(f"brightness agreement {brightness_agreement:6.2%}")
+    for (ref_color, fast_color), count in disagreements.most_common(10):
+        print(f"  kmeans {ref_color:<8} -> {method} {fast_color:<8} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dominant color detection")
+    parser.add_argument('--agreement', action='store_true', help='compare a fast method against kmeans')
+    parser.add_argument('--method', choices=['histogram', 'minibatch'], default='histogram')
+    parser.add_argument('--sample', type=int, default=500, help='number of random keyframes to compare')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.agreement:
+        keyframes = sorted(f for f in os.listdir(KEYFRAMES_DIR) if f.endswith('.jpg'))
+        random.seed(42)
+        sample = random.sample(keyframes, min(args.sample, len(keyframes)))
+        agreement_report([os.path.join(KEYFRAMES_DIR, f) for f in sample], args.method, args.workers)
+    else:
+        # Colors are computed by utils/metadata_creation.py, the command line only runs the comparison
+        parser.print_usage()
+
+
+if __name__ == "__main__":
+    main()
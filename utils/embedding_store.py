@@ -0,0 +1,207 @@
+""" Sharded, append-only store for CLIP embeddings.
+
+    Replaces one {shot}_embeddings.npy file per keyframe with a few large
+    raw matrices that are opened with np.memmap:
+
+        data/processed/embedding_store/
+            store.json          dim, dtype and committed rows of every shard
+            shard_00000.bin     rows x dim float32 (or float16) matrix
+            shard_00000.ids     one shot name per line, same order as the rows
+
+    store.json is only rewritten after the shard data is on disk, so readers
+    never see rows that were not fully written.
+
+    Convert the old per-file embeddings with:
+        python -m utils.embedding_store migrate --src data/processed/embeddings
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+STORE_DIR = 'data/processed/embedding_store'
+LEGACY_EMBEDDINGS_DIR = 'data/processed/embeddings'
+
+
+class EmbeddingStore:
+    """ Append-only matrix of embeddings with a shot name per row """
+
+    def __init__(self, path=STORE_DIR, dim=512, dtype='float32', shard_size=1000000):
+        self.path = path
+        self.meta_path = os.path.join(path, 'store.json')
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"dim": dim, "dtype": dtype, "shard_size": shard_size, "shards": []}
+
+        self.dim = self.meta['dim']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self._names = None
+        self._name_to_row = None
+
+    def __len__(self):
+        return sum(shard['rows'] for shard in self.meta['shards'])
+
+    def _shard_path(self, shard, ext):
+        return os.path.join(self.path, f"{shard['name']}.{ext}")
+
+    def shard_matrix(self, shard_idx):
+        """ Zero-copy read-only view of one shard """
+        shard = self.meta['shards'][shard_idx]
+        if shard['rows'] == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        return np.memmap(self._shard_path(shard, 'bin'), dtype=self.dtype, mode='r',
+                         shape=(shard['rows'], self.dim))
+
+    def shard_names(self, shard_idx):
+        shard = self.meta['shards'][shard_idx]
+        with open(self._shard_path(shard, 'ids'), 'rb') as f:
+            data = f.read(shard['ids_bytes'])
+        return data.decode('utf-8').splitlines()
+
+    def names(self):
+        """ Shot names of all rows in store order """
+        if self._names is None:
+            self._names = []
+            for shard_idx in range(len(self.meta['shards'])):
+                self._names.extend(self.shard_names(shard_idx))
+        return self._names
+
+    def row_of(self, name):
+        if self._name_to_row is None:
+            self._name_to_row = {name: row for row, name in enumerate(self.names())}
+        return self._name_to_row.get(name)
+
+    def __contains__(self, name):
+        return self.row_of(name) is not None
+
+    def iter_shards(self):
+        """ Yield (first_row, names, matrix) for every shard """
+        first_row = 0
+        for shard_idx in range(len(self.meta['shards'])):
+            matrix = self.shard_matrix(shard_idx)
+            yield first_row, self.shard_names(shard_idx), matrix
+            first_row += len(matrix)
+
+    def iter_chunks(self, chunk_rows=100000):
+        """ Yield (first_row, names, float32 matrix) chunks.
+
+            float32 stores are returned as memmap views without copying.
+        """
+        for first_row, names, matrix in self.iter_shards():
+            for start in range(0, len(matrix), chunk_rows):
+                chunk = matrix[start:start + chunk_rows]
+                if chunk.dtype != np.float32:
+                    chunk = chunk.astype('float32')
+                yield first_row + start, names[start:start + chunk_rows], chunk
+
+    def get_rows(self, rows):
+        """ Embeddings of the given global rows as float32, in the given order """
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows), self.dim), dtype='float32')
+        for first_row, _, matrix in self.iter_shards():
+            in_shard = (rows >= first_row) & (rows < first_row + len(matrix))
+            if in_shard.any():
+                out[in_shard] = matrix[rows[in_shard] - first_row]
+        return out
+
+    def get(self, names):
+        """ Embeddings for the given shot names as float32 """
+        rows = [self.row_of(name) for name in names]
+        if None in rows:
+            raise KeyError(f"{names[rows.index(None)]} is not in the embedding store")
+        return self.get_rows(rows)
+
+    def append(self, names, vectors):
+        """ Append a batch of embeddings, filling the last shard before starting a new one """
+        if len(names) == 0:
+            return
+        vectors = np.asarray(vectors).reshape(len(names), self.dim).astype(self.dtype, copy=False)
+        os.makedirs(self.path, exist_ok=True)
+
+        start = 0
+        while start < len(names):
+            shards = self.meta['shards']
+            if not shards or shards[-1]['rows'] >= self.meta['shard_size']:
+                shards.append({"name": f"shard_{len(shards):05d}", "rows": 0, "ids_bytes": 0})
+            shard = shards[-1]
+
+            end = min(len(names), start + self.meta['shard_size'] - shard['rows'])
+            ids_data = ''.join(f"{name}\n" for name in names[start:end]).encode('utf-8')
+
+            # Drop anything past the committed size left behind by an interrupted write
+            self._write_at(self._shard_path(shard, 'bin'),
+                           shard['rows'] * self.dim * self.dtype.itemsize,
+                           np.ascontiguousarray(vectors[start:end]).tobytes())
+            self._write_at(self._shard_path(shard, 'ids'), shard['ids_bytes'], ids_data)
+
+            shard['rows'] += end - start
+            shard['ids_bytes'] += len(ids_data)
+            start = end
+
+        self._commit()
+        if self._names is not None:
+            self._names.extend(names)
+        self._name_to_row = None
+
+    @staticmethod
+    def _write_at(path, offset, data):
+        with open(path, 'ab') as f:
+            f.truncate(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _commit(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=4)
+        os.replace(tmp_path, self.meta_path)
+
+
+def migrate(src_dir=LEGACY_EMBEDDINGS_DIR, dst_dir=STORE_DIR, dtype='float32', batch_size=10000):
+    """ Copy per-file {shot}_embeddings.npy into the store, skipping shots already in it """
+    store = EmbeddingStore(dst_dir, dtype=dtype)
+    embedding_files = sorted(f for f in os.listdir(src_dir) if f.endswith('_embeddings.npy'))
+    todo = [f for f in embedding_files if f.replace('_embeddings.npy', '') not in store]
+
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        vectors = np.stack([np.load(os.path.join(src_dir, f)).squeeze() for f in batch]).astype('float32')
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        store.append([f.replace('_embeddings.npy', '') for f in batch], vectors)
+        print(f"Migrated {start + len(batch)}/{len(todo)} embeddings")
+
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidated CLIP embedding store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='convert per-file .npy embeddings')
+    migrate_parser.add_argument('--src', default=LEGACY_EMBEDDINGS_DIR)
+    migrate_parser.add_argument('--dst', default=STORE_DIR)
+    migrate_parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+    migrate_parser.add_argument('--batch-size', type=int, default=10000)
+
+    info_parser = subparsers.add_parser('info', help='print store size and shards')
+    info_parser.add_argument('--path', default=STORE_DIR)
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        store = migrate(args.src, args.dst, args.dtype, args.batch_size)
+        print(f"Store at {args.dst} holds {len(store)} embeddings")
+    elif args.command == 'info':
+        store = EmbeddingStore(args.path)
+        print(f"{len(store)} embeddings, dim {store.dim}, {store.dtype}")
+        for shard in store.meta['shards']:
+            print(f"  {shard['name']}: {shard['rows']} rows")
+
+
+if __name__ == "__main__":
+    main()
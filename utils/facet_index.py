@@ -0,0 +1,98 @@
+""" In-memory bitset index over the object, color and brightness facets of the shot catalog.
+
+    Every facet value gets a packed bitset over shot rows and a packed bitset
+    over videos (the videos with at least one shot having the value). Filters
+    are then a handful of vectorized AND/OR operations instead of loops over
+    videos and shots:
+
+        shots:  all selected objects AND any selected color AND any selected brightness
+        videos: every selected value occurs in some shot of the video
+
+    Matching shots stay a bool mask over catalog rows; shot ids are only
+    looked up for the videos that are displayed.
+"""
+import numpy as np
+
+FACETS = ('objects', 'colors', 'brightness')
+
+
+def _bitset(rows, size):
+    mask = np.zeros(size, dtype=bool)
+    mask[rows] = True
+    return np.packbits(mask)
+
+
+class FacetIndex:
+    """ Packed per-value bitsets over shots and videos """
+
+    def __init__(self, catalog):
+        """ Arg: ShotCatalog, the bitsets are over its rows """
+        self.catalog = catalog
+        self.shot_ids = catalog.shot_id
+        self.videos = np.array(catalog.videos, dtype=object)
+        self.shot_video = catalog.video
+        self.n_shots = len(catalog)
+        self.n_videos = len(catalog.videos)
+
+        all_rows = np.arange(self.n_shots)
+        object_rows = np.repeat(all_rows, np.diff(catalog.object_indptr))
+        facet_codes = {
+            'objects': (object_rows, catalog.object_indices, catalog.object_values),
+            'colors': (all_rows, catalog.dominant_color, catalog.color_values),
+            'brightness': (all_rows, catalog.brightness, catalog.brightness_values),
+        }
+
+        self.shot_bits = {}
+        self.video_bits = {}
+        for facet, (rows, codes, names) in facet_codes.items():
+            self.shot_bits[facet], self.video_bits[facet] = self._build_facet(rows, np.asarray(codes), names)
+
+    def _build_facet(self, rows, codes, names):
+        shot_bits, video_bits = {}, {}
+        keep = codes >= 0
+        codes, rows = codes[keep], rows[keep]
+
+        # Group rows by value with one sort instead of a scan per value
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+        for i, name in enumerate(names):
+            value_rows = rows[order[bounds[i]:bounds[i + 1]]]
+            shot_bits[name] = _bitset(value_rows, self.n_shots)
+            video_bits[name] = _bitset(self.shot_video[value_rows], self.n_videos)
+        return shot_bits, video_bits
+
+    def values(self, facet):
+        """ Sorted values of a facet, for the filter options """
+        return sorted(self.shot_bits[facet])
+
+    def _get(self, bits, facet, value, size):
+        found = bits[facet].get(value)
+        return found if found is not None else np.zeros((size + 7) // 8, dtype=np.uint8)
+
+    def shot_mask(self, objects=(), colors=(), brightness=()):
+        """ Bool mask over catalog rows of the shots that match the filters """
+        result = np.full((self.n_shots + 7) // 8, 0xFF, dtype=np.uint8)
+        for obj in objects:
+            result &= self._get(self.shot_bits, 'objects', obj, self.n_shots)
+        for facet, selected in (('colors', colors), ('brightness', brightness)):
+            if selected:
+                any_of = np.zeros_like(result)
+                for value in selected:
+                    any_of |= self._get(self.shot_bits, facet, value, self.n_shots)
+                result &= any_of
+        return np.unpackbits(result, count=self.n_shots).astype(bool)
+
+    def shot_ids_in_videos(self, shot_mask, video_ids):
+        """ Ids of the shots of the given videos that are set in shot_mask """
+        ranges = [self.catalog.video_rows(video_id) for video_id in video_ids]
+        rows = np.concatenate([np.arange(r.start, r.stop) for r in ranges] + [np.empty(0, dtype='int64')])
+        return set(self.shot_ids[rows[shot_mask[rows]]].tolist())
+
+    def matching_videos(self, objects=(), colors=(), brightness=()):
+        """ Video ids that contain every selected value in at least one shot """
+        result = np.full((self.n_videos + 7) // 8, 0xFF, dtype=np.uint8)
+        for facet, selected in zip(FACETS, (objects, colors, brightness)):
+            for value in selected:
+                result &= self._get(self.video_bits, facet, value, self.n_videos)
+        mask = np.unpackbits(result, count=self.n_videos).astype(bool)
+        return set(self.videos[mask].tolist())
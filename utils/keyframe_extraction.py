@@ -1,29 +1,60 @@
+""" Detect shots with TransNetV2 and extract the best quality keyframe of every shot.
+
+    By default every video is decoded once: the same frames feed TransNetV2
+    (downscaled to 48x27) and the keyframe quality scorer.
+
+    Usage (from the main folder):
+        python -m utils.keyframe_extraction                      # all videos not processed yet
+        python -m utils.keyframe_extraction --method sequential  # TransNetV2 decode + OpenCV decode
+        python -m utils.keyframe_extraction --videos 00001 00002
+        python -m utils.keyframe_extraction --frames-per-shot 4 --frame-sampling change
+        python -m utils.keyframe_extraction --benchmark data/videos/00001.mp4
+"""
+import argparse
 import os
 import sys
 import numpy as np
 import cv2
 import json
-import concurrent.futures
-
-
-
-# Get the list of videos in the data/videos directory
-videos_list = sorted([f for f in os.listdir('data/videos') if f.endswith('.mp4')])
+import tempfile
+import time
+from collections import deque
 
 # Add TransNetV2 to your Python path
 sys.path.append('models/TransNetV2/inference')
 
+VIDEOS_DIR = 'data/videos'
+
 # Create output directory for keyframes
 output_dir = "data/processed/keyframes"
+shot_info_dir = "data/processed/video_shot_info"
+
+# Extra frames per shot for multi-frame CLIP search, "{video}_shot_{i}_f{j}.jpg"
+frames_dir = "data/processed/shot_frames"
+
+# Every 12th frame of a shot is scored
+SAMPLE_STEP = 12
 
-from transnetv2 import TransNetV2
+# TransNetV2 input frame size (width, height)
+TRANSNET_SIZE = (48, 27)
 
-# The path to the video file
-# video_name = "00001"
-# video_path = f"data/videos/{video_name}.mp4"
+# Extra shot frames are stored with this shorter side, the CLIP input size
+FRAME_SIZE = 224
 
-# Initialize the TransNetV2 model
-model = TransNetV2()
+# Candidate frames held per open shot; beyond that every other one is dropped
+MAX_FRAME_CANDIDATES = 64
+
+# The TransNetV2 model is loaded on first use
+_model = None
+
+
+def get_model():
+    """ Initialize the TransNetV2 model once """
+    global _model
+    if _model is None:
+        from transnetv2 import TransNetV2
+        _model = TransNetV2()
+    return _model
 
 
 def extract_shots(video_path):
@@ -31,6 +62,7 @@ def extract_shots(video_path):
         Args: Video path
         Returns: list of scenes [(start_frame, end_frame), ...]
     """
+    model = get_model()
     _, single_frame_predictions, _ = \
         model.predict_video(video_path)
     scenes = model.predictions_to_scenes(single_frame_predictions)
@@ -43,34 +75,25 @@ def calculate_frame_quality(frame):
     gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
     gray = cv2.GaussianBlur(gray, (3, 3), 0) # Reduce noise
     sharpness = cv2.Laplacian(gray, cv2.CV_64F).var() # Variance of Laplacian
-    contrast = gray.std() 
-    
-    return sharpness + contrast * 0.5
+    contrast = gray.std()
 
+    return sharpness + contrast * 0.5
 
-def extract_keyframes(video_path, video_name, scenes):
-    """ Extract keyframes based on shot quality
-        Return video FPS, Duration, and keyframe
-        start and end times.
-    """
-    # Open video to extract actual frames
-    cap = cv2.VideoCapture(video_path)
 
-    # Get the video FPS and Duration
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-    duration = frame_count / fps
-    
-    shots_info = []
+def select_keyframes_seek(cap, scenes, step=SAMPLE_STEP):
+    """ Seek to every sampled frame of every shot.
 
-    # Extract best quality frame from each shot
+        Every cap.set forces the decoder to reseek from the previous
+        keyframe, kept for benchmarking against select_keyframes.
+        Yields (shot_idx, best_frame_num, best_frame) for every shot.
+    """
     for i, (start_frame, end_frame) in enumerate(scenes):
         best_frame = None
         best_quality = 0
         best_frame_num = start_frame
 
         # Sample every 12th frame in the shot
-        for frame_num in range(start_frame, end_frame, 12):
+        for frame_num in range(start_frame, end_frame, step):
             cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
             ret, frame = cap.read()
 
@@ -82,12 +105,76 @@ def extract_keyframes(video_path, video_name, scenes):
                     best_frame = frame.copy()
                     best_frame_num = frame_num
 
+        yield i, best_frame_num, best_frame
+
+
+def select_keyframes(cap, scenes, step=SAMPLE_STEP):
+    """ Single forward decoding pass over the video.
+
+        Scores the same sampled frames as select_keyframes_seek, but frames
+        in between are only grabbed, never seeked to. Only the running best
+        frame of the current shot is kept in memory, and each shot is yielded
+        as (shot_idx, best_frame_num, best_frame) as soon as the pass leaves it.
+    """
+    frame_num = 0
+    ok = True
+
+    for i, (start_frame, end_frame) in enumerate(scenes):
+        best_frame = None
+        best_quality = 0
+        best_frame_num = start_frame
+
+        for sample_num in range(start_frame, end_frame, step):
+            # Decode without retrieving up to the next sampled frame
+            while ok and frame_num < sample_num:
+                ok = cap.grab()
+                frame_num += 1
+            if not ok:
+                break
+
+            ret, frame = cap.read()
+            frame_num += 1
+            if not ret:
+                ok = False
+                break
+
+            # Find the best quality frame in the shot
+            quality = calculate_frame_quality(frame)
+            if quality > best_quality:
+                best_quality = quality
+                best_frame = frame
+                best_frame_num = sample_num
+
+        yield i, best_frame_num, best_frame
+
+
+def extract_keyframes(video_path, video_name, scenes, select=select_keyframes,
+                      keyframes_dir=output_dir, info_dir=shot_info_dir, verbose=True):
+    """ Extract keyframes based on shot quality
+        Return video FPS, Duration, and keyframe
+        start and end times.
+    """
+    # Open video to extract actual frames
+    cap = cv2.VideoCapture(video_path)
+
+    # Get the video FPS and Duration
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    duration = frame_count / fps
+
+    shots_info = []
+
+    # Extract best quality frame from each shot
+    for i, best_frame_num, best_frame in select(cap, scenes):
         if best_frame is not None:
+            start_frame, end_frame = scenes[i]
+
             #Save the frame as an image
             filename = f"{video_name}_shot_{i}.jpg"
-            filepath = os.path.join(output_dir, filename)
+            filepath = os.path.join(keyframes_dir, filename)
             cv2.imwrite(filepath, best_frame)
-            print(f"Saved keyframe {i+1}/{len(scenes)}: {filename}")
+            if verbose:
+                print(f"Saved keyframe {i+1}/{len(scenes)}: {filename}")
 
             # Calculate times for the shot and keyframe
             start_time = start_frame / fps
@@ -113,17 +200,350 @@ def extract_keyframes(video_path, video_name, scenes):
         "shots": shots_info
     }
     # Save the JSON file to data/processed/video_shot_info
-    output_json = f"data/processed/video_shot_info/{video_name}_shots.json"
+    output_json = os.path.join(info_dir, f"{video_name}_shots.json")
+    with open(output_json, 'w') as f:
+        json.dump(video_info, f, indent=4)
+
+    return video_info
+
+
+def _small_frame(frame, size=FRAME_SIZE):
+    """ Downscale so the shorter side is size pixels """
+    h, w = frame.shape[:2]
+    scale = size / min(h, w)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def _color_histogram(frame):
+    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1, 2], None, [8, 4, 4], [0, 180, 0, 256, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
+
+
+def select_shot_frames(candidates, n, sampling='uniform'):
+    """ Pick n of a shot's (frame_num, frame, histogram) candidates, in time order.
+
+        uniform spreads them evenly over the shot, change keeps the first
+        frame and the frames whose colors differ most from the frame before.
+    """
+    if len(candidates) <= n:
+        return candidates
+    if sampling == 'change':
+        change = [np.inf] + [cv2.compareHist(a[2], b[2], cv2.HISTCMP_BHATTACHARYYA)
+                             for a, b in zip(candidates, candidates[1:])]
+        picked = np.sort(np.argsort(change, kind='stable')[::-1][:n])
+    else:
+        picked = np.unique(np.linspace(0, len(candidates) - 1, n).round().astype(int))
+    return [candidates[i] for i in picked]
+
+
+class StreamingShotDetector:
+    """ Runs TransNetV2 on frames as they are decoded.
+
+        Builds the same 100-frame windows with a 50-frame stride and 25
+        frames of padding as TransNetV2.predict_frames, so predictions are
+        identical, but only keeps one window of 48x27 frames in memory.
+        Predictions lag the decoder by at most 75 frames.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.window = []
+        self.n_frames = 0
+        self.n_predicted = 0
+
+    def _run_windows(self):
+        predictions = []
+        while len(self.window) >= 100:
+            single_frame_pred, _ = self.model.predict_raw(np.array(self.window[:100])[np.newaxis])
+            predictions.append(single_frame_pred.numpy()[0, 25:75, 0])
+            self.window = self.window[50:]
+        if not predictions:
+            return np.empty(0)
+        predictions = np.concatenate(predictions)
+        # Padding at the end of the video produces predictions past the last frame
+        predictions = predictions[:self.n_frames - self.n_predicted]
+        self.n_predicted += len(predictions)
+        return predictions
+
+    def push(self, small_frame):
+        """ Add one RGB 48x27 frame, returns the predictions that became available """
+        if self.n_frames == 0:
+            # The first window is padded with copies of the first frame
+            self.window.extend([small_frame] * 25)
+        self.window.append(small_frame)
+        self.n_frames += 1
+        return self._run_windows()
+
+    def finish(self):
+        """ Pad with copies of the last frame and return the remaining predictions """
+        if self.n_frames == 0:
+            return np.empty(0)
+        no_padded_frames_end = 25 + 50 - (self.n_frames % 50 if self.n_frames % 50 != 0 else 50)
+        self.window.extend([self.window[-1]] * no_padded_frames_end)
+        return self._run_windows()
+
+
+class ShotKeyframeTracker:
+    """ Turns streamed TransNetV2 predictions into shots and picks their keyframes.
+
+        Follows TransNetV2.predictions_to_scenes frame by frame. Scored sample
+        frames wait in a short queue until their prediction arrives; then they
+        either belong to the open shot (only its best frame is kept) or fall on
+        a transition and are dropped. A shot is returned as soon as its end
+        boundary is confirmed.
+
+        With frames_per_shot > 0 downscaled copies of the shot's sample frames
+        are kept as well and frames_per_shot of them are picked when the shot
+        closes (see select_shot_frames). Long shots keep at most
+        MAX_FRAME_CANDIDATES candidates by halving the sampling rate.
+    """
+
+    def __init__(self, threshold=0.5, frames_per_shot=0, sampling='uniform'):
+        self.threshold = threshold
+        self.frames_per_shot = frames_per_shot
+        self.sampling = sampling
+        self.pending = deque()
+        self.frame_num = -1
+        self.t_prev = 0
+        self.t = 0
+        self.start = 0
+        self.n_shots = 0
+        self.best = None
+        # Most recent sample frame, kept for shots too short to contain one
+        self.last_sample = None
+        self.nearest_samples = {}
+        self._reset_frames()
+
+    def _reset_frames(self):
+        self.frames = []
+        self.frame_stride = 1
+        self.frames_seen = 0
+
+    def _add_frame(self, frame_num, frame):
+        if self.frames_seen % self.frame_stride == 0:
+            small_frame = _small_frame(frame)
+            self.frames.append((frame_num, small_frame, _color_histogram(small_frame)))
+            if len(self.frames) > MAX_FRAME_CANDIDATES:
+                self.frames = self.frames[::2]
+                self.frame_stride *= 2
+        self.frames_seen += 1
+
+    def add_candidate(self, frame_num, quality, frame):
+        self.pending.append((frame_num, quality, frame))
+
+    def _close_shot(self, end_frame):
+        best_frame_num, best_frame = (self.best[1], self.best[2]) if self.best else (self.start, None)
+        if self.best is None and self.last_sample is not None:
+            self.nearest_samples[self.n_shots] = self.last_sample
+        frames = [(frame_num, frame) for frame_num, frame, _ in
+                  select_shot_frames(self.frames, self.frames_per_shot, self.sampling)]
+        shot = (self.n_shots, self.start, end_frame, best_frame_num, best_frame, frames)
+        self.n_shots += 1
+        self.best = None
+        self._reset_frames()
+        return shot
+
+    def add_predictions(self, predictions):
+        """ Returns completed shots as (shot_idx, start, end, best_frame_num, best_frame, frames) """
+        shots = []
+        for prediction in predictions:
+            self.frame_num += 1
+            i = self.frame_num
+            self.t = int(prediction > self.threshold)
+
+            if self.t_prev == 1 and self.t == 0:
+                self.start = i
+            if self.t_prev == 0 and self.t == 1 and i != 0:
+                shots.append(self._close_shot(i))
+            self.t_prev = self.t
+
+            # Sample frames up to i now know which shot they belong to
+            while self.pending and self.pending[0][0] <= i:
+                frame_num, quality, frame = self.pending.popleft()
+                self.last_sample = (frame_num, frame)
+                if frame_num != i or self.t == 1:
+                    continue
+                if self.best is None or quality > self.best[0]:
+                    self.best = (quality, frame_num, frame)
+                if self.frames_per_shot:
+                    self._add_frame(frame_num, frame)
+        return shots
+
+    def finish(self):
+        """ Close the last shot once all predictions were added """
+        if self.frame_num < 0:
+            return []
+        if self.t == 0 or self.n_shots == 0:
+            return [self._close_shot(self.frame_num)]
+        return []
+
+
+def extract_shots_and_keyframes(video_path, video_name, step=SAMPLE_STEP,
+                                keyframes_dir=output_dir, info_dir=shot_info_dir, verbose=True,
+                                frames_per_shot=0, frame_sampling='uniform', shot_frames_dir=frames_dir):
+    """ Single decode per video for shot detection and keyframe scoring.
+
+        Every decoded frame is downscaled for TransNetV2, every step-th frame
+        of the video is scored with calculate_frame_quality. Keyframes are
+        written as soon as TransNetV2 confirms the end of their shot. Shots
+        without a scored frame (shorter than step) get their first frame,
+        read with one seek after the pass, or the nearest earlier sample
+        frame if that read fails; shots without either are left out.
+
+        frames_per_shot > 0 also saves up to that many extra frames of every
+        shot to shot_frames_dir, listed under "frames" in the shot info.
+    """
+    detector = StreamingShotDetector(get_model())
+    tracker = ShotKeyframeTracker(frames_per_shot=frames_per_shot, sampling=frame_sampling)
+    if frames_per_shot:
+        os.makedirs(shot_frames_dir, exist_ok=True)
+
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    duration = frame_count / fps
+
+    shots_info = []
+    missing_keyframes = []
+
+    def save_shots(shots):
+        for i, start_frame, end_frame, best_frame_num, best_frame, frames in shots:
+            filename = f"{video_name}_shot_{i}.jpg"
+            filepath = os.path.join(keyframes_dir, filename)
+            nearest = tracker.nearest_samples.pop(i, None)
+            if best_frame is None:
+                # Written now as a fallback, the seek after the pass replaces it with the first frame
+                if nearest is not None:
+                    best_frame_num = nearest[0]
+                    cv2.imwrite(filepath, nearest[1])
+                missing_keyframes.append((i, start_frame, filepath, nearest is not None))
+            else:
+                cv2.imwrite(filepath, best_frame)
+                if verbose:
+                    print(f"Saved keyframe {i+1}: {filename}")
+
+            shot_info = {
+                "shot_name": f"shot_{i}",
+                "start_time": start_frame / fps,
+                "end_time": end_frame / fps,
+                "keyframe_path": filepath,
+                "keyframe_time": best_frame_num / fps
+            }
+            if frames:
+                shot_info["frames"] = []
+                for j, (frame_num, frame) in enumerate(frames):
+                    frame_path = os.path.join(shot_frames_dir, f"{video_name}_shot_{i}_f{j}.jpg")
+                    cv2.imwrite(frame_path, frame)
+                    shot_info["frames"].append({"path": frame_path, "time": frame_num / fps})
+            shots_info.append(shot_info)
+
+    frame_num = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        if frame_num % step == 0:
+            tracker.add_candidate(frame_num, calculate_frame_quality(frame), frame)
+
+        small_frame = cv2.cvtColor(cv2.resize(frame, TRANSNET_SIZE, interpolation=cv2.INTER_AREA),
+                                   cv2.COLOR_BGR2RGB)
+        save_shots(tracker.add_predictions(detector.push(small_frame)))
+        frame_num += 1
+
+    save_shots(tracker.add_predictions(detector.finish()))
+    save_shots(tracker.finish())
+
+    # Short shots without a sampled frame
+    shot_infos = {info['shot_name']: info for info in shots_info}
+    for i, start_frame, filepath, has_fallback in missing_keyframes:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        ret, frame = cap.read()
+        if ret:
+            cv2.imwrite(filepath, frame)
+            shot_infos[f"shot_{i}"]["keyframe_time"] = start_frame / fps
+        elif not has_fallback:
+            shots_info.remove(shot_infos[f"shot_{i}"])
+            print(f"Left out shot {i} of {video_name}: frame {start_frame} could not be read")
+    cap.release()
+
+    video_info = {
+        "video_name": video_name,
+        "fps": fps,
+        "duration": duration,
+        "shots": shots_info
+    }
+    output_json = os.path.join(info_dir, f"{video_name}_shots.json")
     with open(output_json, 'w') as f:
         json.dump(video_info, f, indent=4)
 
+    return video_info
+
+
+def benchmark_keyframe_selection(video_path, scenes=None):
+    """ Compare wall time of seek-based and sequential keyframe selection on one video """
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    if scenes is None:
+        scenes = extract_shots(video_path)
+    print(f"{video_name}: {len(scenes)} shots")
+
+    keyframe_times = {}
+    wall_times = {}
+    for name, select in (("seek", select_keyframes_seek), ("sequential", select_keyframes)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            video_info = extract_keyframes(video_path, video_name, scenes, select,
+                                           keyframes_dir=tmp_dir, info_dir=tmp_dir, verbose=False)
+            wall_times[name] = time.perf_counter() - start
+        keyframe_times[name] = [shot['keyframe_time'] for shot in video_info['shots']]
+        print(f"{name:<12} {wall_times[name]:8.2f}s")
+
+    print(f"speedup      {wall_times['seek'] / wall_times['sequential']:8.2f}x")
+    print(f"same keyframes selected: {keyframe_times['seek'] == keyframe_times['sequential']}")
+    return wall_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract shots and keyframes from videos")
+    parser.add_argument('--videos', nargs='*', help='video ids to process (default: all not processed yet)')
+    parser.add_argument('--method', choices=['fused', 'sequential', 'seek'], default='fused',
+                        help='fused decodes once; sequential/seek decode with TransNetV2 and OpenCV separately')
+    parser.add_argument('--frames-per-shot', type=int, default=0,
+                        help='extra frames saved per shot for multi-frame search (fused method only)')
+    parser.add_argument('--frame-sampling', choices=['uniform', 'change'], default='uniform',
+                        help='spread extra frames evenly or pick the frames where the colors change most')
+    parser.add_argument('--benchmark', metavar='VIDEO_PATH',
+                        help='time seek-based vs sequential keyframe selection on one video')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_keyframe_selection(args.benchmark)
+        return
+
+    # Get the list of videos in the data/videos directory
+    videos_list = sorted([f for f in os.listdir(VIDEOS_DIR) if f.endswith('.mp4')])
+    if args.videos:
+        videos_list = [f"{video_name}.mp4" for video_name in args.videos]
+    else:
+        videos_list = [f for f in videos_list if not os.path.exists(
+            os.path.join(shot_info_dir, f"{f.split('.')[0]}_shots.json"))]
 
-for video_file in videos_list[0]:
-    # Remove the .mp4 extension from the name
-    video_name = video_file.split('.')[0]
-    video_path = f"data/videos/{video_file}"
-    print(f"Processing {video_file}...")
-    scenes = extract_shots(video_path)
-    extract_keyframes(video_path, video_name, scenes)
+    select = select_keyframes if args.method == 'sequential' else select_keyframes_seek
+    for video_file in videos_list:
+        # Remove the .mp4 extension from the name
+        video_name = video_file.split('.')[0]
+        video_path = os.path.join(VIDEOS_DIR, video_file)
+        print(f"Processing {video_file}...")
+        if args.method == 'fused':
+            extract_shots_and_keyframes(video_path, video_name, frames_per_shot=args.frames_per_shot,
+                                        frame_sampling=args.frame_sampling)
+            continue
+        scenes = extract_shots(video_path)
+        extract_keyframes(video_path, video_name, scenes, select)
 
 
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,30 @@
+""" Create metadata JSON (dominant color, brightness, detected objects) for every keyframe.
+
+    Usage (from the main folder):
+        python -m utils.metadata_creation                        # all videos
+        python -m utils.metadata_creation --videos 00001 00002
+        python -m utils.metadata_creation --color-method histogram   # fast dominant colors
+"""
+import argparse
 import json
 import os
-from color_detection import get_dominant_color
-from YOLO_object_detection import get_objects
+from utils.color_detection import get_dominant_color, get_dominant_colors
+from utils.YOLO_object_detection import get_objects_batch
 
-# List of videos inside 'data/videos' folder
-videos_list = sorted([f for f in os.listdir('data/videos') if f.endswith('.mp4')])
+VIDEOS_DIR = 'data/videos'
+KEYFRAMES_DIR = 'data/processed/keyframes'
+METADATA_DIR = 'data/processed/metadata'
 
 
-def create_metadata(video_name, shot_name, input_path):
-    # Get dominant color and brightness
-    color, brightness = get_dominant_color(input_path)
+def create_metadata(video_name, shot_name, input_path, color=None, brightness=None, object_confidences=None):
+    # Get dominant color and brightness unless they were computed in a batch
+    if color is None:
+        color, brightness = get_dominant_color(input_path)
 
-    # Load image for object detection
-    objects = get_objects(input_path)
+    # Load image for object detection unless it was part of a batch
+    if object_confidences is None:
+        object_confidences = get_objects_batch([input_path])[0]
+    objects = list(object_confidences)
 
     # Prepare metadata dictionary
     metadata = {
@@ -21,27 +33,54 @@ def create_metadata(video_name, shot_name, input_path):
         "keyframe_path": input_path,
         "dominant_color": color,
         "brightness": brightness,
-        "detected_objects": objects
+        "detected_objects": objects,
+        "object_confidences": object_confidences
     }
-    
+
     # Save to JSON
-    output_path = f'data/processed/metadata/{shot_name}_{video_name}_metadata.json'
+    output_path = os.path.join(METADATA_DIR, f'{shot_name}_{video_name}_metadata.json')
     with open(output_path, 'w') as f:
         json.dump(metadata, f, indent=4)
 
 
-
-### ONLY TAKE 5 VIDEOS FOR TESTING
-for video_file in videos_list[100:]:
-    video_name = video_file.split('.')[0]
-
+def create_video_metadata(video_name, keyframes_dir=KEYFRAMES_DIR, color_method='kmeans', workers=None,
+                          yolo_batch_size=32, yolo_imgsz=640):
+    """ Create metadata for all keyframes of one video, returns the number of shots """
     # Get all shots from the video
-    keyframes = [f for f in os.listdir('data/processed/keyframes') if f.startswith(video_name)]
+    keyframes = [f for f in os.listdir(keyframes_dir) if f.startswith(f"{video_name}_shot_")]
+    input_paths = [os.path.join(keyframes_dir, shot) for shot in keyframes]
+
+    # Colors and objects of the whole video in batches
+    colors = get_dominant_colors(input_paths, color_method, workers)
+    detections = get_objects_batch(input_paths, yolo_batch_size, yolo_imgsz)
 
-    for shot in keyframes:
-        input_path = f'data/processed/keyframes/{shot}'
-        shot_name = shot[6:] # Remove 'video_name_' prefix
+    for shot, input_path, (color, brightness), objects in zip(keyframes, input_paths, colors, detections):
+        shot_name = shot[len(video_name) + 1:] # Remove 'video_name_' prefix
         shot_name = shot_name.split('.')[0] # Remove file extension
-        create_metadata(video_name, shot_name, input_path)
-    
-    print(f"Metadata created for all shots in {video_file}")
\ No newline at end of file
+        create_metadata(video_name, shot_name, input_path, color, brightness, objects)
+
+    return len(keyframes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create metadata for keyframes")
+    parser.add_argument('--videos', nargs='*', help='video ids to process (default: all)')
+    parser.add_argument('--color-method', choices=['kmeans', 'histogram', 'minibatch'], default='kmeans',
+                        help='histogram and minibatch are fast approximations of kmeans, see utils/color_detection.py')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes for dominant color detection')
+    parser.add_argument('--yolo-batch-size', type=int, default=32)
+    parser.add_argument('--yolo-imgsz', type=int, default=640, help='YOLO inference resolution')
+    args = parser.parse_args()
+
+    # List of videos inside 'data/videos' folder
+    videos_list = args.videos or sorted(f.split('.')[0] for f in os.listdir(VIDEOS_DIR) if f.endswith('.mp4'))
+
+    for video_name in videos_list:
+        create_video_metadata(video_name, color_method=args.color_method, workers=args.workers,
+                              yolo_batch_size=args.yolo_batch_size, yolo_imgsz=args.yolo_imgsz)
+        print(f"Metadata created for all shots in {video_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+""" LRU cache of CLIP query embeddings with an optional SQLite tier on disk,
+    and an in-memory LRU of final search and filter results.
+
+    Keys are the model id plus the normalized query text (lowercase, single
+    spaces, which is what the CLIP tokenizer sees anyway), so reruns with an
+    unchanged query and queries differing only in case or spacing reuse the
+    same embedding. The disk tier keeps embeddings across app restarts.
+
+    ResultCache keys also hold the selected filters and the snapshot
+    version (utils/snapshots.py), so results are never served from an older
+    catalog or index and need no invalidation.
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+QUERY_CACHE_PATH = 'data/processed/query_cache.sqlite'
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+class QueryEmbeddingCache:
+    """ Thread-safe in-memory LRU with an optional disk tier """
+
+    def __init__(self, maxsize=4096, disk_path=None):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = None
+        if disk_path:
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False)
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    model_id TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model_id, query)
+                ) WITHOUT ROWID
+                """
+            )
+            self.conn.commit()
+
+    def get(self, model_id, query):
+        """ Cached float32 embedding of the normalized query, or None """
+        key = (model_id, query)
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return embedding
+
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model_id = ? AND query = ?", key
+                ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype='float32')
+                    self._remember(key, embedding)
+                    self.hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, model_id, query, embedding):
+        key = (model_id, query)
+        embedding = np.asarray(embedding, dtype='float32').ravel()
+        embedding.setflags(write=False)
+        with self.lock:
+            self._remember(key, embedding)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (model_id, query, embedding) VALUES (?, ?, ?)",
+                    (model_id, query, embedding.tobytes())
+                )
+                self.conn.commit()
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def __len__(self):
+        return len(self.memory)
+
+
+def search_key(query, n_videos, objects, colors, brightness, version):
+    """ ResultCache key of a ranked search, filter order does not matter """
+    return ('search', normalize_query(query), n_videos, tuple(sorted(objects)), tuple(sorted(colors)),
+            tuple(sorted(brightness)), version)
+
+
+def filter_key(objects, colors, brightness, version):
+    """ ResultCache key of the videos and shots matching a set of filters """
+    return ('filter', tuple(sorted(objects)), tuple(sorted(colors)), tuple(sorted(brightness)), version)
+
+
+class ResultCache:
+    """ Thread-safe LRU of final results, shared by all sessions.
+
+        Every entry has a cost, e.g. the number of shots or ids it holds,
+        and the least recently used entries are evicted while the total is
+        above max_cost. Cached values are shared, callers must not modify them.
+    """
+
+    def __init__(self, max_cost=1000000):
+        self.max_cost = max_cost
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, cost=1):
+        if cost > self.max_cost:
+            return
+        with self.lock:
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.cost -= old[1]
+            self.memory[key] = (value, cost)
+            self.cost += cost
+            while self.cost > self.max_cost:
+                _, (_, evicted_cost) = self.memory.popitem(last=False)
+                self.cost -= evicted_cost
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.memory), "cost": self.cost, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self.memory)
@@ -0,0 +1,261 @@
+""" Query-side CLIP text encoder for the app and the search server.
+
+    Only the text tower (text transformer + projection) and the tokenizer
+    are loaded, never the vision tower or the image processor. Loading
+    happens on a background thread started by warm_up(), so the UI is
+    usable while the model loads; encode() waits for it if needed.
+
+    Backends (QUERY_ENCODER environment variable / search_server.py --encoder):
+        torch               transformers text tower
+        torch-int8          same with dynamic int8 quantization of the Linear layers (CPU)
+        torchscript[-int8]  traced graph exported to data/processed/query_encoder
+        onnx                exported ONNX graph run with onnxruntime (optional dependency)
+
+    Usage (from the main folder):
+        python -m utils.query_encoder export --format torchscript --int8
+        python -m utils.query_encoder export --format onnx
+        python -m utils.query_encoder benchmark --encoder torch-int8
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+MODEL_ID = "openai/clip-vit-base-patch32"
+
+QUERY_ENCODER_DIR = 'data/processed/query_encoder'
+
+# CLIP's text context length
+MAX_TOKENS = 77
+
+
+def _text_tower(model_id):
+    """ CLIP text transformer and projection as one module returning normalized embeddings """
+    import torch
+    try:
+        from transformers import CLIPTextModelWithProjection
+        model = CLIPTextModelWithProjection.from_pretrained(model_id)
+    except ImportError:
+        # transformers < 4.25: load the full model once and keep the text half only
+        from transformers import CLIPModel
+        model = CLIPModel.from_pretrained(model_id)
+        del model.vision_model, model.visual_projection
+
+    class TextTower(torch.nn.Module):
+
+        def __init__(self, text_model, text_projection):
+            super().__init__()
+            self.text_model = text_model
+            self.text_projection = text_projection
+
+        def forward(self, input_ids, attention_mask):
+            pooled = self.text_model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[1]
+            features = self.text_projection(pooled)
+            return features / features.norm(dim=-1, keepdim=True)
+
+    return TextTower(model.text_model, model.text_projection).eval()
+
+
+def _quantize(tower):
+    import torch
+    return torch.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_path(fmt, int8=False, path=QUERY_ENCODER_DIR):
+    ext = 'onnx' if fmt == 'onnx' else 'pt'
+    return os.path.join(path, f"text_encoder{'_int8' if int8 else ''}.{ext}")
+
+
+class QueryEncoder:
+    """ Lazily loaded text encoder, see the module docstring for the backends """
+
+    def __init__(self, spec='torch', model_id=MODEL_ID, path=QUERY_ENCODER_DIR, threads=None):
+        self.spec = spec
+        self.backend, _, suffix = spec.partition('-')
+        self.int8 = suffix == 'int8'
+        if self.backend not in ('torch', 'torchscript', 'onnx') or suffix not in ('', 'int8'):
+            raise ValueError(f"Unknown query encoder {spec!r}")
+        if self.backend == 'onnx' and self.int8:
+            raise ValueError("int8 is only supported for the torch and torchscript encoders")
+        self.model_id = model_id
+        self.path = path
+        self.threads = threads
+        # Embeddings of the int8 encoder differ slightly, so they are cached separately
+        self.cache_id = f"{model_id}:int8" if self.int8 else model_id
+
+        self.dim = None
+        self.load_seconds = None
+        self._tokenizer = None
+        self._model = None
+        self._device = None
+        self._error = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._model is not None
+
+    def warm_up(self):
+        """ Load and run the encoder once on a background thread, returns self """
+        if self._thread is None and not self.ready:
+            self._thread = threading.Thread(target=self._warm_up, name='query-encoder-warm-up', daemon=True)
+            self._thread.start()
+        return self
+
+    def _warm_up(self):
+        try:
+            self.load()
+            self.encode(["a photo"])
+        except Exception as e:
+            print(f"Query encoder warm-up failed: {e}")
+
+    def load(self):
+        """ Load the tokenizer and model unless done already; raises the error of a failed load """
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if self._model is None:
+                start = time.perf_counter()
+                try:
+                    self._load()
+                except Exception as e:
+                    self._error = e
+                    raise
+                self.load_seconds = time.perf_counter() - start
+                print(f"Loaded {self.spec} query encoder in {self.load_seconds:.1f}s")
+        return self
+
+    def _load(self):
+        from transformers import CLIPTokenizerFast
+        self._tokenizer = CLIPTokenizerFast.from_pretrained(self.model_id)
+
+        if self.backend == 'onnx':
+            import onnxruntime
+            model = onnxruntime.InferenceSession(export_path('onnx', path=self.path),
+                                                 providers=['CPUExecutionProvider'])
+            self.dim = model.get_outputs()[0].shape[-1]
+            self._model = model
+            return
+
+        import torch
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        if self.backend == 'torchscript':
+            model = torch.jit.load(export_path('torchscript', self.int8, self.path), map_location='cpu')
+            self._device = torch.device('cpu')
+            with open(os.path.join(self.path, 'text_encoder.json'), 'r') as f:
+                self.dim = json.load(f)['dim']
+        else:
+            model = _text_tower(self.model_id)
+            self.dim = model.text_projection.out_features
+            if self.int8:
+                model = _quantize(model)
+                self._device = torch.device('cpu')
+            else:
+                self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+                model.to(self._device)
+        self._model = model
+
+    def encode(self, texts):
+        """ (len(texts), dim) float32 matrix of L2-normalized text embeddings """
+        self.load()
+        if not texts:
+            return np.empty((0, self.dim), dtype='float32')
+
+        if self.backend == 'onnx':
+            inputs = self._tokenizer(text=list(texts), return_tensors='np', padding=True,
+                                     truncation=True, max_length=MAX_TOKENS)
+            return self._model.run(None, {"input_ids": inputs['input_ids'].astype('int64'),
+                                          "attention_mask": inputs['attention_mask'].astype('int64')})[0]
+
+        import torch
+        inputs = self._tokenizer(text=list(texts), return_tensors='pt', padding=True,
+                                 truncation=True, max_length=MAX_TOKENS).to(self._device)
+        with torch.inference_mode():
+            features = self._model(inputs['input_ids'], inputs['attention_mask'])
+        return features.cpu().numpy().astype('float32')
+
+
+def export(fmt, int8=False, model_id=MODEL_ID, path=QUERY_ENCODER_DIR):
+    """ Trace the text tower to TorchScript or ONNX, returns the exported file """
+    import torch
+    from transformers import CLIPTokenizerFast
+
+    os.makedirs(path, exist_ok=True)
+    tower = _text_tower(model_id)
+    dim = tower.text_projection.out_features
+    if int8:
+        tower = _quantize(tower)
+
+    tokenizer = CLIPTokenizerFast.from_pretrained(model_id)
+    inputs = tokenizer(text=["a photo of a dog", "a car"], return_tensors='pt', padding=True)
+    example = (inputs['input_ids'], inputs['attention_mask'])
+
+    out_path = export_path(fmt, int8, path)
+    with torch.no_grad():
+        if fmt == 'onnx':
+            torch.onnx.export(tower, example, out_path, input_names=['input_ids', 'attention_mask'],
+                              output_names=['text_embeds'], opset_version=14,
+                              dynamic_axes={'input_ids': {0: 'batch', 1: 'tokens'},
+                                            'attention_mask': {0: 'batch', 1: 'tokens'},
+                                            'text_embeds': {0: 'batch'}})
+        else:
+            torch.jit.save(torch.jit.trace(tower, example), out_path)
+
+    with open(os.path.join(path, 'text_encoder.json'), 'w') as f:
+        json.dump({"model_id": model_id, "dim": dim}, f, indent=4)
+    return out_path
+
+
+def benchmark(spec, queries, threads=None):
+    """ Cold load time, peak RSS and per-query latency of one encoder """
+    start = time.perf_counter()
+    encoder = QueryEncoder(spec, threads=threads).load()
+    load_seconds = time.perf_counter() - start
+
+    encoder.encode(queries[:1])
+    start = time.perf_counter()
+    for query in queries:
+        encoder.encode([query])
+    ms_per_query = (time.perf_counter() - start) * 1000 / len(queries)
+
+    try:
+        import resource # Unix only
+        peak_rss = f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:7.0f} MB"
+    except ImportError:
+        peak_rss = f"{'n/a':>10}"
+    print(f"{spec:<18} load {load_seconds:6.2f}s  peak RSS {peak_rss}  {ms_per_query:6.2f} ms/query")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query-side CLIP text encoder")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='export the text tower as TorchScript or ONNX')
+    export_parser.add_argument('--format', choices=['torchscript', 'onnx'], default='torchscript')
+    export_parser.add_argument('--int8', action='store_true', help='dynamic int8 quantization (TorchScript only)')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='load time, RSS and latency of an encoder')
+    benchmark_parser.add_argument('--encoder', default='torch',
+                                  help='torch, torch-int8, torchscript, torchscript-int8 or onnx')
+    benchmark_parser.add_argument('--threads', type=int, default=None)
+    benchmark_parser.add_argument('--n-queries', type=int, default=100)
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        if args.int8 and args.format == 'onnx':
+            parser.error("--int8 is only supported for TorchScript")
+        print(f"Exported to {export(args.format, args.int8)}")
+    elif args.command == 'benchmark':
+        # One encoder per run, peak RSS is that of the whole process
+        queries = [f"a person riding a bike number {i}" for i in range(args.n_queries)]
+        benchmark(args.encoder, queries, args.threads)
+
+
+if __name__ == "__main__":
+    main()
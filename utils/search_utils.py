@@ -1,18 +1,37 @@
-def gather_all_unique_objects(videos, get_shots_by_vide):
-    all_shots = []
-    all_objects = set()
-    for v in videos:
-        shots = get_shots_by_vide(v['video_id'])
-        all_shots.extend(shots)
-        for shot in shots:
-            objs = shot.get('detected_objects', [])
-            normalized_objs = []
-            if isinstance(objs, str):
-                normalized_objs = [o.strip(" []'\"") for o in objs.split(',') if o.strip(" []'\"")]
-            elif isinstance(objs, list):
-                for o in objs:
-                    if isinstance(o, str):
-                        normalized_objs.extend([x.strip(" []'\"") for x in o.split(',') if x.strip(" []'\"")])
-            all_objects.update(normalized_objs)
-    return sorted(all_objects), all_shots
+class SearchResults:
+    """ Ranking of one query, built once and looked up per displayed video.
 
+        ordered_shots holds the best shot of every ranked video (with its
+        similarity as 'score' when it comes from the CLIP search). Shot
+        dicts are only made for the videos that are displayed.
+    """
+
+    def __init__(self, ordered_video_ids, ordered_shots, catalog):
+        self.video_ids = ordered_video_ids
+        self.catalog = catalog
+        self.rank = {video_id: i + 1 for i, video_id in enumerate(ordered_video_ids)}
+        self.best_shot = {shot['video_id']: shot for shot in ordered_shots if shot}
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def order_videos(self, videos):
+        """ Ranked videos first in rank order, the rest in their original order """
+        unranked = len(self.rank) + 1
+        return sorted(videos, key=lambda v: self.rank.get(v['video_id'], unranked))
+
+    def score(self, video_id):
+        best = self.best_shot.get(video_id)
+        return best.get('score') if best else None
+
+    def is_best_shot(self, shot):
+        best = self.best_shot.get(shot['video_id'])
+        return best is not None and best['shot_id'] == shot['shot_id']
+
+    def shots(self, video_id):
+        """ Shots of the video, best match first and the rest by time """
+        shots = self.catalog.shots(self.catalog.video_rows(video_id))
+        best = [shot for shot in shots if self.is_best_shot(shot)]
+        if not best:
+            return shots
+        return best + [shot for shot in shots if shot is not best[0]]
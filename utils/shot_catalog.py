@@ -0,0 +1,261 @@
+""" Columnar in-memory catalog of all shots.
+
+    Replaces the list of shot dicts: every field is a NumPy column, video,
+    color and brightness are categorical codes, strings are one UTF-8 blob
+    plus offsets and the objects of every shot are a CSR list of object
+    codes. Rows are ordered by video and start time, so the shots of a
+    video are one contiguous row range.
+
+    The catalog can be saved as a folder of .npy files and opened with
+    mmap, which lets several app processes share one copy in the page cache:
+
+        python -m utils.shot_catalog build
+        python -m utils.shot_catalog info
+"""
+import argparse
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from db.db_utils import DB_PATH, get_read_connection, load_shot_columns, load_shot_object_columns
+
+CATALOG_DIR = 'data/processed/shot_catalog'
+
+ARRAYS = ('shot_id', 'video', 'start_time', 'end_time', 'keyframe_time', 'brightness', 'dominant_color',
+          'shot_name_data', 'shot_name_offsets', 'keyframe_path_data', 'keyframe_path_offsets',
+          'object_indptr', 'object_indices', 'shot_id_order', 'video_indptr')
+
+
+STAMP_KEYS = ('db_version', 'db_shots', 'db_max_shot_id', 'db_shot_objects')
+
+
+def _db_stamp(db_path):
+    """ Changes whenever shots are inserted, replaced or deleted (the file mtime does not under WAL).
+
+        db_version is the content version db/insert_data.py writes with every
+        change; the counts cover databases written before it existed.
+    """
+    conn = get_read_connection(db_path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    except sqlite3.OperationalError:
+        row = None # no meta table yet
+    n_shots, max_shot_id = conn.execute("SELECT COUNT(*), MAX(shot_id) FROM shots").fetchone()
+    n_objects = conn.execute("SELECT COUNT(*) FROM shot_objects").fetchone()[0]
+    return dict(zip(STAMP_KEYS, (row[0] if row else None, n_shots, max_shot_id, n_objects)))
+
+
+def db_version(db_path=DB_PATH):
+    """ Version of the DB contents, equal to ShotCatalog.version() of a catalog built from them """
+    return tuple(_db_stamp(db_path).values())
+
+
+def _rows_of_shot_ids(shot_id, shot_id_order, shot_ids):
+    shot_ids = np.asarray(shot_ids, dtype='int64')
+    if len(shot_id) == 0:
+        return np.full(len(shot_ids), -1, dtype='int64')
+    sorted_ids = shot_id[shot_id_order]
+    pos = np.minimum(np.searchsorted(sorted_ids, shot_ids), len(sorted_ids) - 1)
+    rows = np.asarray(shot_id_order[pos], dtype='int64')
+    rows[sorted_ids[pos] != shot_ids] = -1
+    return rows
+
+
+class ShotCatalog:
+    """ All shots as NumPy columns, see the module docstring """
+
+    def __init__(self, arrays, values, meta=None):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.videos = list(values['videos'])
+        self.brightness_values = list(values['brightness'])
+        self.color_values = list(values['colors'])
+        self.object_values = list(values['objects'])
+        self.meta = meta or {}
+        self._video_code = {video_id: code for code, video_id in enumerate(self.videos)}
+
+    @classmethod
+    def from_db(cls, db_path=DB_PATH):
+        # One read transaction, so the stamp describes exactly the rows read even while an ingest commits
+        conn = get_read_connection(db_path)
+        conn.execute("BEGIN")
+        try:
+            stamp = _db_stamp(db_path)
+            columns = load_shot_columns(db_path)
+            objects = load_shot_object_columns(db_path)
+        finally:
+            conn.execute("COMMIT")
+        n_shots = len(columns['shot_id'])
+        arrays = {name: columns[name] for name in ('shot_id', 'start_time', 'end_time', 'keyframe_time',
+                                                   'brightness', 'dominant_color')}
+        arrays['video'] = columns['video_id']
+        for name in ('shot_name_data', 'shot_name_offsets', 'keyframe_path_data', 'keyframe_path_offsets'):
+            arrays[name] = columns[name]
+
+        # shot_id -> row through a sorted permutation instead of a dict
+        arrays['shot_id_order'] = np.argsort(columns['shot_id'], kind='stable')
+
+        # Rows are sorted by video, so every video is a row range
+        arrays['video_indptr'] = np.zeros(len(columns['video_id_values']) + 1, dtype='int64')
+        np.cumsum(np.bincount(columns['video_id'], minlength=len(columns['video_id_values'])),
+                  out=arrays['video_indptr'][1:])
+
+        # Objects as CSR over rows
+        rows = _rows_of_shot_ids(arrays['shot_id'], arrays['shot_id_order'], objects['shot_id'])
+        known = rows >= 0
+        rows, codes = rows[known], objects['object'][known]
+        order = np.argsort(rows, kind='stable')
+        arrays['object_indices'] = codes[order].astype('int32')
+        arrays['object_indptr'] = np.zeros(n_shots + 1, dtype='int64')
+        np.cumsum(np.bincount(rows, minlength=n_shots), out=arrays['object_indptr'][1:])
+
+        values = {
+            "videos": columns['video_id_values'].tolist(),
+            "brightness": columns['brightness_values'].tolist(),
+            "colors": columns['dominant_color_values'].tolist(),
+            "objects": objects['object_values'].tolist(),
+        }
+        return cls(arrays, values, stamp)
+
+    def save(self, path=CATALOG_DIR):
+        """ Write the arrays as .npy files, catalog.json last so readers never see a half-written catalog """
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            with open(os.path.join(path, f"{name}.npy"), 'wb') as f:
+                np.save(f, np.ascontiguousarray(getattr(self, name)))
+        catalog = dict(self.meta, n_shots=len(self), values={
+            "videos": self.videos, "brightness": self.brightness_values,
+            "colors": self.color_values, "objects": self.object_values,
+        })
+        tmp_path = os.path.join(path, 'catalog.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(catalog, f)
+        os.replace(tmp_path, os.path.join(path, 'catalog.json'))
+
+    @classmethod
+    def load(cls, path=CATALOG_DIR, mmap=True):
+        with open(os.path.join(path, 'catalog.json'), 'r') as f:
+            catalog = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None)
+                  for name in ARRAYS}
+        values = catalog.pop('values')
+        return cls(arrays, values, catalog)
+
+    def is_fresh(self, db_path=DB_PATH):
+        """ Whether the catalog was built from the current DB contents """
+        return os.path.exists(db_path) and all(self.meta.get(k) == v for k, v in _db_stamp(db_path).items())
+
+    def version(self):
+        return tuple(self.meta.get(key) for key in STAMP_KEYS)
+
+    def __len__(self):
+        return len(self.shot_id)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    # Lookups
+
+    def rows_of_shot_ids(self, shot_ids):
+        """ Rows of the given shot ids, -1 for unknown ids """
+        return _rows_of_shot_ids(self.shot_id, self.shot_id_order, shot_ids)
+
+    def video_code(self, video_id):
+        return self._video_code.get(video_id)
+
+    def video_rows(self, video_id):
+        """ Rows of the video's shots, in start time order """
+        code = self._video_code.get(video_id)
+        if code is None:
+            return range(0)
+        return range(int(self.video_indptr[code]), int(self.video_indptr[code + 1]))
+
+    def _string(self, column, row):
+        data = getattr(self, f"{column}_data")
+        offsets = getattr(self, f"{column}_offsets")
+        return bytes(data[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def shot_name(self, row):
+        return self._string('shot_name', row)
+
+    def shot_names(self):
+        """ Shot names of all rows """
+        data = self.shot_name_data.tobytes()
+        offsets = self.shot_name_offsets.tolist()
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(self))]
+
+    def keyframe_path(self, row):
+        return self._string('keyframe_path', row)
+
+    def objects(self, row):
+        codes = self.object_indices[self.object_indptr[row]:self.object_indptr[row + 1]]
+        return [self.object_values[code] for code in codes]
+
+    def shot(self, row):
+        """ One shot as the dict the app displays """
+        def value(values, code):
+            return values[code] if code >= 0 else None
+
+        def time(t):
+            return None if np.isnan(t) else float(t)
+
+        return {
+            "row": int(row),
+            "shot_id": int(self.shot_id[row]),
+            "video_id": self.videos[self.video[row]],
+            "shot_name": self.shot_name(row),
+            "start_time": time(self.start_time[row]),
+            "end_time": time(self.end_time[row]),
+            "keyframe_time": time(self.keyframe_time[row]),
+            "keyframe_path": self.keyframe_path(row),
+            "brightness": value(self.brightness_values, self.brightness[row]),
+            "dominant_color": value(self.color_values, self.dominant_color[row]),
+            "detected_objects": self.objects(row),
+        }
+
+    def shots(self, rows):
+        return [self.shot(row) for row in rows]
+
+
+def load_catalog(path=CATALOG_DIR, db_path=DB_PATH):
+    """ The prebuilt catalog if it matches the DB, otherwise a fresh one built from the DB """
+    if os.path.exists(os.path.join(path, 'catalog.json')):
+        catalog = ShotCatalog.load(path)
+        if catalog.is_fresh(db_path):
+            return catalog
+    return ShotCatalog.from_db(db_path)
+
+
+def build_catalog(path=CATALOG_DIR, db_path=DB_PATH):
+    catalog = ShotCatalog.from_db(db_path)
+    catalog.save(path)
+    return catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar shot catalog")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='build the catalog from the database')
+    build_parser.add_argument('--db-path', default=DB_PATH)
+    build_parser.add_argument('--out', default=CATALOG_DIR)
+
+    info_parser = subparsers.add_parser('info', help='print catalog size')
+    info_parser.add_argument('--path', default=CATALOG_DIR)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        catalog = build_catalog(args.out, args.db_path)
+        print(f"Catalog of {len(catalog)} shots in {args.out}")
+    elif args.command == 'info':
+        catalog = ShotCatalog.load(args.path)
+        print(f"{len(catalog)} shots of {len(catalog.videos)} videos, {len(catalog.object_values)} object classes")
+        print(f"{catalog.nbytes() / 1024 ** 2:.1f} MB, {catalog.nbytes() / max(len(catalog), 1):.0f} bytes per shot")
+        print("fresh" if catalog.is_fresh() else "stale, rebuild with: python -m utils.shot_catalog build")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+""" Versioned snapshots of the shot catalog, facet index and FAISS search engine with hot reload.
+
+    A Snapshot bundles everything a query reads. A query takes
+    manager.current once and uses it to the end, so a new snapshot is
+    swapped in with a single attribute assignment: queries in flight keep
+    the old one, which is freed when the last of them finishes.
+
+    A watcher thread polls for new versions, which is cheap:
+        catalog   PRAGMA data_version of the thread's SQLite connection (it
+                  changes on every commit of another connection), and only
+                  then the shot counts that make up the catalog version
+        index     the version id db/faiss_CLIP.py writes last to faiss_clip.json
+    A new version is loaded once it was seen on two polls in a row, so a
+    running ingest does not cause a reload per video. Unchanged parts are
+    reused, and the FAISS index is memory-mapped, so the old and the new
+    index share the page cache while both are alive.
+
+    Usage (from the main folder):
+        python -m utils.snapshots --poll-seconds 5   # print every reload until interrupted
+"""
+import argparse
+import threading
+import time
+
+from db.db_utils import DB_PATH, get_read_connection
+from utils.shot_catalog import load_catalog, db_version
+from utils.facet_index import FacetIndex
+
+
+class Snapshot:
+    """ Catalog, facet index and search engine of one (catalog version, index version) """
+
+    def __init__(self, catalog, facet_index=None, index_version=None, search_index=None, search_engine=None):
+        self.catalog = catalog
+        self.facet_index = facet_index
+        self.search_index = search_index
+        self.search_engine = search_engine
+        self.version = (catalog.version(), index_version)
+        self.loaded_at = time.time()
+
+
+class SnapshotManager:
+    """ Holds the current snapshot and reloads newer versions on a watcher thread """
+
+    def __init__(self, snapshot, db_path=DB_PATH, search=True, facets=True, poll_seconds=10, mmap=True):
+        self.current = snapshot
+        self.db_path = db_path
+        self.search = search
+        self.facets = facets
+        self.poll_seconds = poll_seconds
+        self.mmap = mmap
+
+        self.reloads = 0
+        self.last_error = None
+        self._data_version = None
+        self._db_version = snapshot.version[0]
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def load(cls, db_path=DB_PATH, search=True, facets=True, **kwargs):
+        """ Load the first snapshot in the calling thread """
+        catalog = load_catalog(db_path=db_path)
+        snapshot = Snapshot(catalog, FacetIndex(catalog) if facets else None)
+        manager = cls(snapshot, db_path, search, facets, **kwargs)
+        if search:
+            manager.reload(manager.latest_version())
+            manager.reloads = 0
+        return manager
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='snapshot-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.poll()
+                self.last_error = None
+            except Exception as e:
+                # Keep serving the current snapshot, the next poll tries again
+                self.last_error = e
+                print(f"Snapshot reload failed: {e}")
+
+    def latest_version(self):
+        """ (catalog version, index version) of what is on disk now """
+        data_version = get_read_connection(self.db_path).execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._db_version = db_version(self.db_path)
+        return self._db_version, self._index_version()
+
+    def _index_version(self):
+        if not self.search:
+            return None
+        from utils.CLIP_search import index_version
+        return index_version()
+
+    def poll(self):
+        """ Reload if a new version was seen on this and the previous poll, returns whether it did """
+        latest = self.latest_version()
+        if latest == self.current.version:
+            self._pending = None
+            return False
+        if latest != self._pending:
+            self._pending = latest
+            return False
+        self.reload(latest)
+        return True
+
+    def reload(self, version):
+        """ Build the snapshot of version, reusing the parts that did not change, and swap it in """
+        with self._lock:
+            start = time.perf_counter()
+            old = self.current
+            catalog_version, index_version = version
+
+            catalog, facet_index = old.catalog, old.facet_index
+            if catalog_version != old.version[0]:
+                catalog = load_catalog(db_path=self.db_path)
+                facet_index = FacetIndex(catalog) if self.facets else None
+
+            search_index, search_engine = old.search_index, old.search_engine
+            if self.search and index_version != old.version[1]:
+                search_index = self._load_search_index()
+            if self.search and (catalog is not old.catalog or search_index is not old.search_index):
+                from utils.CLIP_search import make_search_engine
+                search_engine = make_search_engine(catalog, search_index)
+
+            self.current = Snapshot(catalog, facet_index, index_version, search_index, search_engine)
+            self._pending = None
+            self.reloads += 1
+            print(f"Swapped in snapshot {self.current.version} in {time.perf_counter() - start:.1f}s")
+            return self.current
+
+    def _load_search_index(self):
+        from utils.CLIP_search import load_search_index, load_index_params
+        search_index = load_search_index(self.mmap)
+        # db/faiss_CLIP.py replaces the files one by one, retry until they belong together
+        ntotal = load_index_params().get('ntotal')
+        if search_index is not None and ntotal is not None and search_index[0].ntotal != ntotal:
+            raise RuntimeError("FAISS index files are being replaced")
+        return search_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch the DB and FAISS index for new snapshot versions")
+    parser.add_argument('--db-path', default=DB_PATH)
+    parser.add_argument('--poll-seconds', type=float, default=10)
+    parser.add_argument('--no-search', action='store_true', help='catalog and facets only')
+    args = parser.parse_args()
+
+    manager = SnapshotManager.load(args.db_path, search=not args.no_search, poll_seconds=args.poll_seconds)
+    print(f"Serving snapshot {manager.current.version} with {len(manager.current.catalog)} shots")
+    manager.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        manager.stop()
+
+
+if __name__ == "__main__":
+    main()
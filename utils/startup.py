@@ -0,0 +1,193 @@
+""" Background loading of the app's heavy resources and a startup profile.
+
+    The app only imports light modules at load time. The shot catalog,
+    facet index, FAISS index and query encoder are loaded as named tasks
+    on worker threads (catalog and index at the same time), so the page
+    renders and filtering and browsing work while semantic search is still
+    warming up. faiss, torch and transformers are first imported by these
+    tasks, never by app.py itself. Once all data is loaded, the 'snapshots'
+    task hands it to a SnapshotManager (utils/snapshots.py) that reloads it
+    after an ingest.
+
+    Usage (from the main folder):
+        python -m utils.startup profile            # load what the app loads, print per-task timings
+        python -m utils.startup imports --top 20   # slowest imports of app.py (python -X importtime)
+"""
+import argparse
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules app.py imports at load time, the import profile covers exactly these
+APP_IMPORTS = ['streamlit', 'db.db_utils', 'utils.search_utils', 'utils.query_cache', 'utils.thumbnails',
+               'utils.startup', 'search_client', 'dres_api']
+
+
+class StartupLoader:
+    """ Named loading tasks on worker threads, with the wall time of each """
+
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='startup')
+        self.futures = {}
+        self.timings = {}
+        self.started = time.perf_counter()
+
+    def submit(self, name, func, deps=(), args=()):
+        """ Run func(*results of the deps tasks, *args) once those tasks are loaded """
+        dep_futures = [self.futures[dep] for dep in deps]
+
+        def run():
+            dep_results = [future.result() for future in dep_futures]
+            start = time.perf_counter()
+            status = 'failed'
+            try:
+                result = func(*dep_results, *args)
+                status = 'loaded'
+                return result
+            finally:
+                self.timings[name] = (start - self.started, time.perf_counter() - start)
+                print(f"[startup] {name} {status} after {self.timings[name][1]:.2f}s")
+
+        self.futures[name] = self.executor.submit(run)
+        return self
+
+    def result(self, name, timeout=None):
+        """ Result of a task, waits for it and re-raises its error """
+        return self.futures[name].result(timeout)
+
+    def ready(self, *names):
+        """ Whether all the tasks finished without an error """
+        return all(self.futures[name].done() and self.futures[name].exception() is None for name in names)
+
+    def error(self, name):
+        future = self.futures[name]
+        return future.exception() if future.done() else None
+
+    def report(self):
+        """ One row per task: name, status, start offset and seconds, in start order """
+        rows = []
+        for name, future in self.futures.items():
+            status = 'loading'
+            if future.done():
+                status = 'failed' if future.exception() is not None else 'ready'
+            start, seconds = self.timings.get(name, (None, None))
+            rows.append({"task": name, "status": status, "start_s": start, "seconds": seconds})
+        return sorted(rows, key=lambda row: float('inf') if row['start_s'] is None else row['start_s'])
+
+
+def _load_search_index():
+    """ (index version, search index), the version is read first so a newer index is never missed """
+    from utils.CLIP_search import index_version, load_search_index
+    version = index_version()
+    return version, load_search_index(mmap=True)
+
+
+def _make_search_engine(versioned_index, catalog):
+    from utils.CLIP_search import make_search_engine
+    return make_search_engine(catalog, versioned_index[1])
+
+
+def _start_snapshots(loader, search, facets, poll_seconds):
+    from utils.snapshots import Snapshot, SnapshotManager
+    index_version, search_index = loader.result('index') if search else (None, None)
+    snapshot = Snapshot(loader.result('catalog'), loader.result('facets') if facets else None,
+                        index_version, search_index, loader.result('search') if search else None)
+    manager = SnapshotManager(snapshot, search=search, facets=facets, poll_seconds=poll_seconds)
+    return manager.start() if poll_seconds else manager
+
+
+def _warm_up_encoder(encoder_spec):
+    from utils.query_encoder import QueryEncoder
+    encoder = QueryEncoder(encoder_spec).load()
+    encoder.encode(["a photo"])
+    return encoder
+
+
+def load_app_resources(encoder_spec='torch', search=True, facets=True, poll_seconds=10, loader=None):
+    """ Start loading what the app needs: the catalog, optionally facets and index, engine and encoder.
+
+        Task results: 'catalog' (ShotCatalog), 'facets' (FacetIndex),
+        'search' (ClipSearchEngine or None without an index), 'encoder' and
+        'snapshots' (SnapshotManager over the loaded data, polling every
+        poll_seconds; 0 disables hot reload).
+    """
+    from utils.shot_catalog import load_catalog
+    from utils.facet_index import FacetIndex
+
+    loader = loader or StartupLoader()
+    loader.submit('catalog', load_catalog)
+    if facets:
+        loader.submit('facets', FacetIndex, deps=['catalog'])
+    if search:
+        loader.submit('index', _load_search_index)
+        loader.submit('search', _make_search_engine, deps=['index', 'catalog'])
+        loader.submit('encoder', _warm_up_encoder, args=[encoder_spec])
+
+    snapshot_deps = ['catalog'] + (['facets'] if facets else []) + (['index', 'search'] if search else [])
+    loader.submit('snapshots', lambda *loaded: _start_snapshots(loader, search, facets, poll_seconds),
+                  deps=snapshot_deps)
+    return loader
+
+
+def print_report(loader):
+    print(f"{'task':<10} {'status':<8} {'start':>8} {'seconds':>8}")
+    for row in loader.report():
+        start = '' if row['start_s'] is None else f"{row['start_s']:.2f}"
+        seconds = '' if row['seconds'] is None else f"{row['seconds']:.2f}"
+        print(f"{row['task']:<10} {row['status']:<8} {start:>8} {seconds:>8}")
+
+
+def import_profile(modules=APP_IMPORTS, top=20):
+    """ (cumulative seconds, module) of the slowest imports, measured in a fresh interpreter """
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        module = module[1:].rstrip() # nested imports are indented by two spaces per level
+        imports.append((int(cumulative) / 1e6, module))
+
+    total = sum(seconds for seconds, module in imports if not module.startswith(' '))
+    return total, [(seconds, module.strip()) for seconds, module in sorted(imports, reverse=True)[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="App startup profile")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    profile_parser = subparsers.add_parser('profile', help='load the app resources and print per-task timings')
+    profile_parser.add_argument('--encoder', default='torch', help='query encoder, see utils/query_encoder.py')
+    profile_parser.add_argument('--no-search', action='store_true', help='catalog and facets only')
+
+    imports_parser = subparsers.add_parser('imports', help='import time of the modules app.py imports')
+    imports_parser.add_argument('--top', type=int, default=20)
+
+    args = parser.parse_args()
+
+    if args.command == 'profile':
+        start = time.perf_counter()
+        loader = load_app_resources(args.encoder, search=not args.no_search)
+        for name in loader.futures:
+            try:
+                loader.result(name)
+            except Exception as e:
+                print(f"[startup] {name} failed: {e}")
+        print_report(loader)
+        print(f"All resources loaded after {time.perf_counter() - start:.2f}s")
+    elif args.command == 'imports':
+        total, slowest = import_profile(top=args.top)
+        print(f"app.py imports take {total:.2f}s")
+        for seconds, module in slowest:
+            print(f"{seconds:8.3f}s {module}")
+
+
+if __name__ == "__main__":
+    main()
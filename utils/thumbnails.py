@@ -0,0 +1,110 @@
+""" Small JPEG/WebP thumbnails of the keyframes for the result grid.
+
+    Thumbnails are made at ingest or on first request and kept in
+    data/processed/thumbnails. The directory is bounded in size: when it
+    grows past max_bytes the least recently used thumbnails are deleted
+    (every access refreshes a thumbnail's mtime).
+
+    Usage (from the main folder):
+        python -m utils.thumbnails                     # pregenerate for all keyframes
+        python -m utils.thumbnails --size 256 --format webp
+"""
+import argparse
+import hashlib
+import os
+import threading
+
+from PIL import Image
+
+THUMBNAILS_DIR = 'data/processed/thumbnails'
+KEYFRAMES_DIR = 'data/processed/keyframes'
+
+
+class ThumbnailCache:
+    """ Keyframe path -> thumbnail path, generated on demand """
+
+    def __init__(self, path=THUMBNAILS_DIR, size=320, fmt='jpeg', quality=80, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.size = size
+        self.fmt = fmt.lower()
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def _thumbnail_file(self, keyframe_path):
+        ext = 'webp' if self.fmt == 'webp' else 'jpg'
+        key = hashlib.sha1(f"{os.path.abspath(keyframe_path)}:{self.size}".encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    def get(self, keyframe_path):
+        """ Path of the keyframe's thumbnail, or the keyframe itself if it cannot be made """
+        thumbnail = self._thumbnail_file(keyframe_path)
+        try:
+            if os.path.getmtime(thumbnail) >= os.path.getmtime(keyframe_path):
+                os.utime(thumbnail) # mark as recently used
+                return thumbnail
+        except OSError:
+            pass
+
+        try:
+            return self._make(keyframe_path, thumbnail)
+        except OSError:
+            return keyframe_path
+
+    def _make(self, keyframe_path, thumbnail):
+        with Image.open(keyframe_path) as image:
+            image.draft('RGB', (self.size, self.size)) # JPEG decodes at reduced scale
+            image = image.convert('RGB')
+            image.thumbnail((self.size, self.size))
+
+            # Write under a temporary name so readers never see half a file
+            tmp_path = f"{thumbnail}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, format=self.fmt.upper(), quality=self.quality)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, thumbnail)
+
+        with self.lock:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._prune()
+        return thumbnail
+
+    def _prune(self):
+        """ Delete least recently used thumbnails down to 90% of max_bytes """
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.path) if entry.is_file())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+
+def make_thumbnails(keyframe_paths, cache=None):
+    cache = cache or ThumbnailCache()
+    for keyframe_path in keyframe_paths:
+        cache.get(keyframe_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pregenerate keyframe thumbnails")
+    parser.add_argument('--keyframes-dir', default=KEYFRAMES_DIR)
+    parser.add_argument('--size', type=int, default=320, help='longest side in pixels')
+    parser.add_argument('--format', default='jpeg', choices=['jpeg', 'webp'])
+    parser.add_argument('--max-mb', type=int, default=2048, help='on-disk size limit of the cache')
+    args = parser.parse_args()
+
+    cache = ThumbnailCache(size=args.size, fmt=args.format, max_bytes=args.max_mb * 1024 ** 2)
+    keyframes = sorted(f for f in os.listdir(args.keyframes_dir) if f.endswith('.jpg'))
+    make_thumbnails([os.path.join(args.keyframes_dir, f) for f in keyframes], cache)
+    print(f"Thumbnails of {len(keyframes)} keyframes in {cache.path} ({cache.total_bytes / 1024 ** 2:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()